@@ -0,0 +1,126 @@
+"""Batch trigram scoring for EL mention Benchmark
+
+Compute the per-token trigram overlap scores used by the trigram
+method for a whole batch of (dbr, question) pairs at once. Trigrams
+are interned to integer ids, dbr trigram sets are kept as a sorted
+array of (dbr, trigram) keys (a sparse membership matrix) and question
+tokens as CSR arrays of trigram ids, so every overlap is resolved with
+a single vectorized lookup instead of a python loop per token.
+"""
+
+from utils import ngrams, tokenize_question
+
+import numpy as np
+
+__author__ = "Guillermo Echegoyen"
+__credits__ = ["Guillermo Echegoyen"]
+__license__ = "GPL v3"
+__version__ = "1.0.0"
+__maintainer__ = "Guillermo Echegoyen"
+__email__ = "gblanco@lsi.uned.es"
+__status__ = "Production"
+
+
+class TrigramVocab(object):
+  def __init__(self):
+    self.ids = {}
+
+  def __len__(self):
+    return len(self.ids)
+
+  def intern(self, gram):
+    gram_id = self.ids.get(gram)
+    if gram_id is None:
+      gram_id = len(self.ids)
+      self.ids[gram] = gram_id
+    return gram_id
+
+  def intern_all(self, grams):
+    return [self.intern(gram) for gram in grams]
+
+def _unique_index(items):
+  # position of every item in the list of first seen unique items
+  seen = {}
+  index = [seen.setdefault(item, len(seen)) for item in items]
+  return list(seen), index
+
+def _dbr_keys(dbrs, vocab):
+  # same tokenization as str_to_trigrams_dict, one row per unique dbr
+  rows = []
+  for row, dbr in enumerate(dbrs):
+    gram_ids = set()
+    for point in dbr.lower().split(' '):
+      gram_ids.update(vocab.intern_all(ngrams(point)))
+    rows.append(np.fromiter(gram_ids, dtype=np.int64, count=len(gram_ids)))
+  return rows
+
+def _question_csr(questions, vocab):
+  # same tokenization as get_mentions, every token gets its trigram ids
+  gram_ids, token_lens, token_starts, token_counts = [], [], [], []
+  for question in questions:
+    token_starts.append(len(token_lens))
+    words_trigrams = tokenize_question(question)[2]
+    token_counts.append(len(words_trigrams))
+    for grams in words_trigrams:
+      gram_ids.extend(vocab.intern_all(grams))
+      token_lens.append(len(grams))
+  return (np.array(gram_ids, dtype=np.int64),
+    np.array(token_lens, dtype=np.int64),
+    np.array(token_starts, dtype=np.int64),
+    np.array(token_counts, dtype=np.int64))
+
+def _ranges(starts, lens):
+  # concatenation of range(start, start + len) for every pair
+  total = int(lens.sum())
+  offsets = np.arange(total, dtype=np.int64) - np.repeat(np.cumsum(lens) - lens, lens)
+  return np.repeat(starts, lens) + offsets
+
+def score_pairs(dbrs, questions):
+  """Overlap score of every question token against its dbr trigrams.
+
+  Equivalent to calling overlap_trigrams_score for each token as
+  get_mentions(dbr, question.lower()) does, returns one list of scores
+  per pair.
+  """
+  if len(dbrs) == 0:
+    return []
+  vocab = TrigramVocab()
+  unique_dbrs, dbr_index = _unique_index(dbrs)
+  unique_questions, question_index = _unique_index(questions)
+  dbr_rows = _dbr_keys(unique_dbrs, vocab)
+  gram_ids, token_lens, token_starts, token_counts = _question_csr(unique_questions, vocab)
+  vocab_size = max(1, len(vocab))
+
+  # sparse dbr x trigram matrix as sorted flat keys
+  dbr_keys = np.concatenate([row + index * vocab_size for index, row in enumerate(dbr_rows)])
+  dbr_keys.sort()
+
+  # trigram offsets of each unique question token
+  token_gram_starts = np.cumsum(token_lens) - token_lens
+
+  dbr_index = np.array(dbr_index, dtype=np.int64)
+  question_index = np.array(question_index, dtype=np.int64)
+  # tokens of every pair, gathered from its unique question
+  pair_counts = token_counts[question_index]
+  pair_tokens = _ranges(token_starts[question_index], pair_counts)
+  pair_of_token = np.repeat(np.arange(len(dbrs), dtype=np.int64), pair_counts)
+  # trigrams of every pair token
+  pair_token_lens = token_lens[pair_tokens]
+  pair_grams = gram_ids[_ranges(token_gram_starts[pair_tokens], pair_token_lens)]
+  token_of_gram = np.repeat(np.arange(len(pair_tokens), dtype=np.int64), pair_token_lens)
+
+  keys = dbr_index[pair_of_token[token_of_gram]] * vocab_size + pair_grams
+  positions = np.searchsorted(dbr_keys, keys)
+  positions[positions == len(dbr_keys)] = 0
+  common = np.bincount(token_of_gram, weights=dbr_keys[positions] == keys,
+    minlength=len(pair_tokens))
+  scores = (common / np.maximum(1, pair_token_lens)).tolist()
+
+  ret = []
+  start = 0
+  for count in pair_counts.tolist():
+    ret.append(scores[start:start + count])
+    start += count
+  return ret
+
+__all__ = [ TrigramVocab, score_pairs ]
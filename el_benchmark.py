@@ -20,13 +20,23 @@ __email__ = "gblanco@lsi.uned.es"
 __status__ = "Production"
 
 from os.path import splitext, abspath, basename
-from el_process import process
-from el_evaluate import evaluate_from_dbr, evaluate_from_annotation, evaluate_from_annotation_set
-from utils import find_question, find_error
+from el_process import process_batch
+from el_entities import use_table, table_path
+from el_evaluate import evaluate_from_dbr, evaluate_from_annotation, evaluate_from_annotation_set, read_annotations
+from utils import find_error, ErrorIndex, clean_str_stats
+from el_io import open_records, read_records, batches, imap_bounded, is_binary, DatasetWriter
+from functools import partial
 
+import sys
 import json
 import argparse
 
+WORKER_BATCH_SIZE = 1000
+# functions listed by --profile
+PROFILE_TOP = 15
+# methods of the fused mode, by name: baseline or not
+FUSED_METHODS = { 'process': False, 'baseline': True }
+
 parser = argparse.ArgumentParser()
 parser.add_argument(
   '-d',
@@ -80,55 +90,425 @@ parser.add_argument(
   action='store_true',
   default=False,
   help='Keep answers that were wrong in a separate file.')
+parser.add_argument(
+  '--batch-size',
+  type=int,
+  required=False,
+  default=10000,
+  help='Number of questions processed together.')
+parser.add_argument(
+  '--batch-scoring',
+  required=False,
+  dest='batch_scoring',
+  action='store_true',
+  default=False,
+  help='Score the trigrams of a whole batch at once with numpy (see el_batch).')
+parser.add_argument(
+  '-w',
+  '--workers',
+  type=int,
+  required=False,
+  default=1,
+  help='Number of processes to split the dataset across when processing.')
+parser.add_argument(
+  '-f',
+  '--fused',
+  required=False,
+  dest='fused',
+  action='store_true',
+  default=False,
+  help='Process with both methods and evaluate in a single pass: --output is the prefix of '
+    '<prefix>_process.json and <prefix>_baseline.json, with --keep wrong answers go to '
+    '<evaluated prefix>_<method>_evaluated.json.')
+parser.add_argument(
+  '--evaluated-output',
+  type=str,
+  required=False,
+  default=None,
+  help='Prefix of the wrong answers files of --fused, --output by default.')
+parser.add_argument(
+  '--shards',
+  type=int,
+  required=False,
+  default=None,
+  help='Split the dataset into this many shards (by id hash) and process the shards no other '
+    'worker claimed, with any number of workers (eg: on several nodes) sharing --shard-dir. '
+    'The worker completing the last shard merges the outputs.')
+parser.add_argument(
+  '--shard-dir',
+  type=str,
+  required=False,
+  default=None,
+  help='Directory of the shards, locks and shard outputs, <dataset>_shards by default.')
+parser.add_argument(
+  '--lock-timeout',
+  type=float,
+  required=False,
+  default=None,
+  help='Seconds a lock (of a shard, the split or the merge) may go untouched before it is '
+    'taken over, its worker died (live workers keep touching their locks), 600 by default.')
+parser.add_argument(
+  '--top-k',
+  type=int,
+  required=False,
+  default=None,
+  help='Also keep the k best mentions of every question as its candidates (mention, '
+    'trigram prob and normalized edit distance), best first.')
+parser.add_argument(
+  '--entities',
+  type=str,
+  required=False,
+  default=None,
+  help='DBpedia resource table (el_entities.py output), labels and trigrams of the dbrs in it '
+    'are not computed again.')
+parser.add_argument(
+  '--profile',
+  type=str,
+  required=False,
+  default=None,
+  help='Profile the run (single process): cProfile stats are saved to this path (see pstats), '
+    'time by stage and the top functions go to stderr.')
+parser.add_argument(
+  '--cache-stats',
+  required=False,
+  dest='cache_stats',
+  action='store_true',
+  default=False,
+  help='Print clean_str cache hits/misses (main process only) to stderr.')
 
-FLAGS, unparsed = parser.parse_known_args()
-dataset = abspath(FLAGS.dataset)
-output = FLAGS.output
-
-if output is None:
-  output = splitext(dataset)[0] + '_processed.json'
-
-data = json.load(open(dataset, 'r'))
-output_dataset = {}
-output_dataset['dataset'] = data.get('dataset', { 'id': basename(dataset) })
-output_questions = []
-
-# either process
-if not FLAGS.evaluate:
-  for eval_tuple in data['questions']:
-    output_questions.append(process(eval_tuple, baseline=FLAGS.baseline))
-else:
-  total = len(data['questions'])
-  hits = 0
-  # or evaluate
-  if not FLAGS.annotations:
-    for eval_tuple in data['questions']:
-      if evaluate_from_dbr(eval_tuple):
-        hits +=1
-      elif FLAGS.keep:
-        output_questions.append(eval_tuple)
-    print('Acc {:.4f} ({}/{})'.format(hits/total, hits, total))
-  # evaluate from annotations
+def _process_methods_batch(questions, baselines=(False,), top_k=None, batch_scoring=False):
+  # questions may be a binary dataset slice, records are read in the worker
+  questions = list(questions)
+  return list(zip(*[process_batch(questions, baseline=baseline, top_k=top_k,
+    batch_scoring=batch_scoring) for baseline in baselines]))
+
+def process_methods(questions, baselines=(False,), batch_size=10000, workers=1, top_k=None,
+  batch_scoring=False):
+  """Process all the questions with every method (`baselines`, the
+  baseline flag of each), yields a tuple with the outputs of every
+  method for each question, in a single pass over the questions.
+  Batches are of `batch_size` questions. With more than one worker,
+  batches are spread across a process pool, batches of up to
+  WORKER_BATCH_SIZE keep IPC to a few big messages while still
+  balancing load. Output order is kept. Slices of a binary dataset
+  (el_binary.BinaryDataset) are sent to workers as just their range."""
+  process_fn = partial(_process_methods_batch, baselines=baselines, top_k=top_k,
+    batch_scoring=batch_scoring)
+  if workers > 1:
+    from multiprocessing import Pool
+    # workers load the same entity table, on first use
+    pool = Pool(processes=workers, initializer=use_table, initargs=(table_path(),))
+    try:
+      if hasattr(questions, 'slices'):
+        question_batches = questions.slices(min(batch_size, WORKER_BATCH_SIZE))
+      else:
+        question_batches = batches(questions, min(batch_size, WORKER_BATCH_SIZE))
+      for output_batch in imap_bounded(pool, process_fn, question_batches, workers * 2):
+        for outputs in output_batch:
+          yield outputs
+    finally:
+      pool.close()
+      pool.join()
   else:
-    annotations_dataset = json.load(open(abspath(FLAGS.annotations), 'r'))
-    annotations = annotations_dataset['total']['annotated']
-    annotations_errors = annotations_dataset['total']['errors']
-    total = len(annotations)
-    errors = { k: [] for k in annotations_errors }
-    for annotation in annotations:
-      question = find_question(annotation, data['questions'])
-      assert(question is not None)
-      if evaluate_from_annotation(question, annotation):
-        hits +=1
+    for batch in batches(questions, batch_size):
+      for outputs in process_fn(batch):
+        yield outputs
+
+def process_dataset(questions, baseline=False, batch_size=10000, workers=1, top_k=None,
+  batch_scoring=False):
+  """Process all the questions with a single method, see process_methods"""
+  for outputs in process_methods(questions, (baseline,), batch_size=batch_size, workers=workers,
+    top_k=top_k, batch_scoring=batch_scoring):
+    yield outputs[0]
+
+class DbrEvaluator(object):
+  """Accuracy of processed questions against their own dbr, wrong ones
+  go to `keep` (a DatasetWriter) when given"""
+  def __init__(self, keep=None):
+    self.keep = keep
+    self.total = 0
+    self.hits = 0
+
+  def add(self, eval_tuple):
+    """Evaluate `eval_tuple`, True when it is a hit"""
+    self.total += 1
+    if evaluate_from_dbr(eval_tuple):
+      self.hits +=1
+      return True
+    if self.keep is not None:
+      self.keep.write(eval_tuple)
+    return False
+
+  def report(self):
+    return ['Acc {:.4f} ({}/{})'.format(self.hits/self.total, self.hits, self.total)]
+
+class AnnotationEvaluator(object):
+  """Accuracy of processed questions against annotations (see
+  el_evaluate.read_annotations), errors by kind. Annotations are indexed
+  on (question_id, dbr) once, questions are evaluated as they come
+  against the annotations of their key (the first question of each key,
+  as find_question), so only the annotations side is kept in memory"""
+  def __init__(self, annotations, annotations_errors, keep=None):
+    self.keep = keep
+    self.annotations = annotations
+    self.annotations_errors = annotations_errors
+    # (question_id, dbr) -> indexes of its annotations, until matched
+    self.pending = {}
+    for index, annotation in enumerate(annotations):
+      self.pending.setdefault((annotation['question_id'], annotation['dbr']), []).append(index)
+    # question evaluated against every annotation, None for hits
+    self.matches = [None] * len(annotations)
+    self.matched = 0
+    self.total = len(self.annotations)
+    self.hits = 0
+
+  def add(self, eval_tuple):
+    indexes = self.pending.pop((eval_tuple['question_id'], eval_tuple['dbr']), None)
+    if indexes is None:
+      return
+    for index in indexes:
+      self.matched += 1
+      if evaluate_from_annotation(eval_tuple, self.annotations[index]):
+        self.hits +=1
       else:
-        error_key = find_error(annotation, annotations_errors)
-        errors[error_key].append([question['id'], question['question_id']])
-        if FLAGS.keep:
-          output_questions.append(question)
-    print(json.dumps(errors, ensure_ascii=False))
+        self.matches[index] = eval_tuple
+
+  def report(self):
+    assert(self.matched == self.total)
+    errors = { k: [] for k in self.annotations_errors }
+    errors_index = ErrorIndex(self.annotations_errors)
+    # misses in the order of the annotations
+    for annotation, question in zip(self.annotations, self.matches):
+      if question is None:
+        continue
+      # no bucket (eg: a plain list of annotations), under null
+      error_key = find_error(annotation, errors_index)
+      errors.setdefault(error_key, []).append([question['id'], question['question_id']])
+      if self.keep is not None:
+        self.keep.write(question)
+    return [json.dumps(errors, ensure_ascii=False),
+      'Acc {:.4f} ({}/{})'.format(self.hits/self.total, self.hits, self.total)]
+
+def get_evaluator(annotations, keep=None):
+  if not annotations:
+    return DbrEvaluator(keep=keep)
+  return AnnotationEvaluator(*read_annotations(abspath(annotations)), keep=keep)
+
+def fused_prefixes(FLAGS, dataset):
+  # of the processed and the wrong answers datasets
+  prefix = FLAGS.output
+  if prefix is None:
+    prefix = splitext(dataset)[0]
+  return prefix, FLAGS.evaluated_output or prefix
 
-  print('Acc {:.4f} ({}/{})'.format(hits/total, hits, total))
+def fused(FLAGS, dataset, questions, header):
+  """Process with the trigram method and the baseline side by side and
+  evaluate every output as it comes, no intermediate dataset is read"""
+  prefix, evaluated_prefix = fused_prefixes(FLAGS, dataset)
+  writers = []
+  evaluators = []
+  for name in FUSED_METHODS:
+    writers.append(DatasetWriter('{}_{}.json'.format(prefix, name), header=header))
+    keep = None
+    if FLAGS.keep:
+      keep = DatasetWriter('{}_{}_evaluated.json'.format(evaluated_prefix, name), header=header)
+      writers.append(keep)
+    evaluators.append(get_evaluator(FLAGS.annotations, keep=keep))
+  processed = writers[::2] if FLAGS.keep else writers
+  baselines = tuple(FUSED_METHODS[name] for name in FUSED_METHODS)
+  try:
+    for outputs in process_methods(questions, baselines, batch_size=FLAGS.batch_size,
+      workers=FLAGS.workers, top_k=FLAGS.top_k, batch_scoring=FLAGS.batch_scoring):
+      for output, writer, evaluator in zip(outputs, processed, evaluators):
+        writer.write(output)
+        evaluator.add(output)
+    for name, evaluator in zip(FUSED_METHODS, evaluators):
+      for line in evaluator.report():
+        print('{}: {}'.format(name, line))
+  except BaseException:
+    for writer in writers:
+      writer.abort()
+    raise
+  for writer in writers:
+    writer.close()
+
+def _process_shard(FLAGS, queue, shard, names):
+  """Process (and evaluate, if fused) a shard, outputs keep the original
+  position of every record, returns the counts of the shard"""
+  from el_shards import PositionalWriter, positions_path
+  positions = json.load(open(positions_path(queue.shard_path(shard)), 'r'))
+  records = read_records(queue.shard_path(shard))
+  baselines = tuple(FUSED_METHODS[name] for name in names) if FLAGS.fused else (FLAGS.baseline,)
+  writers = [PositionalWriter(queue.shard_path(shard, name)) for name in names]
+  kept = []
+  evaluators = []
+  if FLAGS.fused:
+    evaluators = [DbrEvaluator() for name in names]
+    if FLAGS.keep:
+      kept = [PositionalWriter(queue.shard_path(shard, name + '_evaluated')) for name in names]
+  try:
+    count = 0
+    for position, outputs in zip(positions, process_methods(records, baselines,
+      batch_size=FLAGS.batch_size, workers=FLAGS.workers, top_k=FLAGS.top_k,
+      batch_scoring=FLAGS.batch_scoring)):
+      count += 1
+      for index, output in enumerate(outputs):
+        writers[index].write(output, position)
+        if len(evaluators) and not evaluators[index].add(output) and len(kept):
+          kept[index].write(output, position)
+  except BaseException:
+    for writer in writers + kept:
+      writer.abort()
+    raise
+  for writer in writers + kept:
+    writer.close()
+  if not FLAGS.fused:
+    return { names[0]: [count] }
+  return { name: [evaluator.hits, evaluator.total] for name, evaluator in zip(names, evaluators) }
+
+def sharded(FLAGS, dataset, output, questions, header):
+  """Process shards of the dataset (see el_shards) until none is left
+  to claim, the worker that completes the last one merges them"""
+  from el_shards import ShardQueue, DEFAULT_LOCK_TIMEOUT
+  shard_dir = FLAGS.shard_dir or splitext(dataset)[0] + '_shards'
+  lock_timeout = FLAGS.lock_timeout if FLAGS.lock_timeout is not None else DEFAULT_LOCK_TIMEOUT
+  queue = ShardQueue(shard_dir, FLAGS.shards, lock_timeout=lock_timeout)
+  split = queue.split(dataset, questions, header)
+  names = list(FUSED_METHODS) if FLAGS.fused else ['processed']
+
+  processed = 0
+  shard = queue.claim()
+  while shard is not None:
+    with queue.hold(queue.shard_lock(shard)) as heartbeat:
+      counts = _process_shard(FLAGS, queue, shard, names)
+    if heartbeat.lost:
+      # taken over as stale, its new owner completes it
+      print('Lost the lock of shard {}, dropping it'.format(shard), file=sys.stderr)
+    else:
+      queue.complete(shard, counts)
+      processed += 1
+    shard = queue.claim()
+
+  # shard output name -> merged output
+  merges = [(names[0], output)]
+  if FLAGS.fused:
+    prefix, evaluated_prefix = fused_prefixes(FLAGS, dataset)
+    merges = [(name, '{}_{}.json'.format(prefix, name)) for name in names]
+    if FLAGS.keep:
+      merges += [(name + '_evaluated', '{}_{}_evaluated.json'.format(evaluated_prefix, name))
+        for name in names]
+  outputs = [merged_output for _, merged_output in merges]
+  if not queue.all_done():
+    print('Processed {} shards, the worker completing the last one merges them'.format(processed),
+      file=sys.stderr)
+    return
+  if queue.is_merged(outputs):
+    print('Processed {} shards, already merged'.format(processed), file=sys.stderr)
+    return
+  if not queue.claim_merge():
+    print('Processed {} shards, another worker is merging them'.format(processed),
+      file=sys.stderr)
+    return
+  with queue.hold_merge() as heartbeat:
+    for name, merged_output in merges:
+      queue.merge(name, merged_output, header=split['header'])
+  if heartbeat.lost:
+    print('Lost the merge lock, its new owner records the merge', file=sys.stderr)
+    return
+  queue.merged(outputs)
+  if not FLAGS.fused:
+    return
+  counts = queue.counts()
+  for name in names:
+    evaluator = DbrEvaluator()
+    evaluator.hits, evaluator.total = counts[name]
+    for line in evaluator.report():
+      print('{}: {}'.format(name, line))
+
+def profile(FLAGS):
+  """Run under cProfile with the per-stage timers (el_instrument) on"""
+  import time
+  import pstats
+  import cProfile
+  from el_instrument import instrumentation
+  if FLAGS.workers > 1:
+    print('Profiling in a single process, ignoring --workers', file=sys.stderr)
+    FLAGS.workers = 1
+  profiler = cProfile.Profile()
+  start = time.perf_counter()
+  with instrumentation:
+    profiler.enable()
+    try:
+      run(FLAGS)
+    finally:
+      profiler.disable()
+  elapsed = time.perf_counter() - start
+  profiler.dump_stats(FLAGS.profile)
+  print('Profile saved to {}, {:.3f} sec'.format(FLAGS.profile, elapsed), file=sys.stderr)
+  print(instrumentation.table(total=elapsed), file=sys.stderr)
+  pstats.Stats(profiler, stream=sys.stderr).sort_stats('tottime').print_stats(PROFILE_TOP)
+
+def run(FLAGS):
+  if FLAGS.top_k is not None and FLAGS.top_k < 1:
+    parser.error('--top-k must be positive')
+  if FLAGS.entities is not None:
+    use_table(abspath(FLAGS.entities))
+  dataset = abspath(FLAGS.dataset)
+  output = FLAGS.output
+
+  if output is None:
+    output = splitext(dataset)[0] + '_processed.json'
+
+  reader, questions = open_records(dataset)
+  header = {}
+  header['dataset'] = reader.header.get('dataset', { 'id': basename(dataset) })
+  if FLAGS.workers > 1 and is_binary(dataset) and not FLAGS.evaluate:
+    from el_binary import BinaryDataset
+    questions = BinaryDataset(dataset)
+
+  if FLAGS.shards is not None:
+    if FLAGS.shards < 1 or FLAGS.evaluate or FLAGS.annotations:
+      parser.error('--shards needs a positive number of shards, it processes (and evaluates '
+        'against the dbr with --fused)')
+    sharded(FLAGS, dataset, output, questions, header)
+    return
+
+  # process and evaluate both methods at once
+  if FLAGS.fused:
+    fused(FLAGS, dataset, questions, header)
+    if FLAGS.cache_stats:
+      print('clean_str cache {}'.format(json.dumps(clean_str_stats())), file=sys.stderr)
+    return
+
+  output_dataset = None
+  if not FLAGS.evaluate or FLAGS.keep:
+    output_dataset = DatasetWriter(output, header=header)
+
+  # either process
+  if not FLAGS.evaluate:
+    output_dataset.write_all(process_dataset(questions, baseline=FLAGS.baseline,
+      batch_size=FLAGS.batch_size, workers=FLAGS.workers, top_k=FLAGS.top_k,
+      batch_scoring=FLAGS.batch_scoring))
+  else:
+    # or evaluate, from dbr or annotations
+    evaluator = get_evaluator(FLAGS.annotations, keep=output_dataset if FLAGS.keep else None)
+    for eval_tuple in questions:
+      evaluator.add(eval_tuple)
+    for line in evaluator.report():
+      print(line)
+
+  if output_dataset is not None:
+    output_dataset.close()
+
+  if FLAGS.cache_stats:
+    print('clean_str cache {}'.format(json.dumps(clean_str_stats())), file=sys.stderr)
+
+def main(FLAGS):
+  if FLAGS.profile is not None:
+    profile(FLAGS)
+  else:
+    run(FLAGS)
 
-output_dataset['questions'] = output_questions
-if not FLAGS.evaluate or FLAGS.keep:
-  json.dump(obj=output_dataset, fp=open(output, 'w'), ensure_ascii=False)
+if __name__ == '__main__':
+  FLAGS, unparsed = parser.parse_known_args()
+  main(FLAGS)
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+
+"""Binary columnar format for QA-EL datasets (.elb)
+
+Records are stored by column: integer columns as int64 arrays, string
+columns as a table of unique utf-8 strings (offsets plus data) and an
+int32 index per record. Files are memory mapped, so opening one costs
+the same whatever its size, and records are only decoded when read.
+Slices of a dataset are views over the same map, pickled as just the
+path and range, so worker processes map the file themselves instead of
+receiving the records.
+
+Layout: magic, 8 byte aligned column blocks, json metadata (header,
+record count and the offset of every block), metadata offset and size
+(uint64) and the magic again.
+
+Usage:
+  el_binary.py -i dataset.json -o dataset.elb
+  el_binary.py -i dataset.elb -o dataset.json
+"""
+
+__author__ = "Guillermo Echegoyen"
+__credits__ = ["Guillermo Echegoyen"]
+__license__ = "GPL v3"
+__version__ = "1.0.0"
+__maintainer__ = "Guillermo Echegoyen"
+__email__ = "gblanco@lsi.uned.es"
+__status__ = "Production"
+
+import os
+import sys
+import json
+import mmap
+import struct
+import argparse
+
+from array import array
+
+MAGIC = b'ELB1'
+VERSION = 1
+ALIGN = 8
+TRAILER = struct.Struct('<QQ4s')
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+  '-i',
+  '--input',
+  type=str,
+  required=True,
+  help='Dataset to convert (.json, .jsonl or .elb).')
+parser.add_argument(
+  '-o',
+  '--output',
+  type=str,
+  required=True,
+  help='Converted dataset, format given by the extension (.json, .jsonl or .elb).')
+
+def _column_type(value):
+  if type(value) is int and -2**63 <= value < 2**63:
+    return 'int'
+  if type(value) is str:
+    return 'str'
+  return 'json'
+
+class _WriterColumn(object):
+  def __init__(self, name, col_type):
+    self.name = name
+    self.type = col_type
+    if col_type == 'int':
+      self.values = array('q')
+    else:
+      self.index = array('i')
+      self.strings = {}
+
+  def accepts(self, value):
+    return self.type == 'json' or _column_type(value) == self.type
+
+  def append(self, value):
+    if self.type == 'int':
+      self.values.append(value)
+      return
+    if self.type == 'json':
+      value = json.dumps(value, ensure_ascii=False)
+    self.index.append(self.strings.setdefault(value, len(self.strings)))
+
+  def to_json(self):
+    # an int or str column got a value of another type
+    if self.type == 'int':
+      values = [json.dumps(value) for value in self.values]
+      del self.values
+    else:
+      strings = [json.dumps(value, ensure_ascii=False) for value in self.strings]
+      values = [strings[index] for index in self.index]
+    self.type = 'json'
+    self.index = array('i')
+    self.strings = {}
+    for value in values:
+      self.index.append(self.strings.setdefault(value, len(self.strings)))
+
+class BinaryWriter(object):
+  """Same interface as el_io.DatasetWriter. Columns are kept in memory
+  (every unique string once) and written on close, atomically"""
+  def __init__(self, path, header=None, key='questions'):
+    self.path = path
+    self.header = header or {}
+    self.key = key
+    self.partial_path = os.path.join(os.path.dirname(path),
+      '.{}.partial'.format(os.path.basename(path)))
+    self.columns = None
+    self.count = 0
+    self.closed = False
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      self.close()
+    else:
+      self.abort()
+
+  def write(self, record):
+    if self.columns is None:
+      self.columns = [_WriterColumn(name, _column_type(value)) for name, value in record.items()]
+    if len(record) != len(self.columns) or \
+      any(column.name != name for column, name in zip(self.columns, record)):
+      raise ValueError('Records must have the same keys, in the same order: {}'.format(
+        list(record)))
+    for column, value in zip(self.columns, record.values()):
+      if not column.accepts(value):
+        column.to_json()
+      column.append(value)
+    self.count += 1
+
+  def write_all(self, records):
+    for record in records:
+      self.write(record)
+
+  def _block(self, fp, data):
+    fp.write(b'\0' * (-fp.tell() % ALIGN))
+    offset = fp.tell()
+    fp.write(data)
+    return [offset, len(data)]
+
+  def close(self, trailer=None):
+    if self.closed:
+      return
+    self.closed = True
+    # no order among top level keys, trailing ones join the header
+    self.header.update(trailer or {})
+    columns = []
+    with open(self.partial_path, 'wb') as fp:
+      fp.write(MAGIC)
+      for column in self.columns or []:
+        meta = { 'name': column.name, 'type': column.type }
+        if column.type == 'int':
+          meta['values'] = self._block(fp, column.values.tobytes())
+        else:
+          encoded = [string.encode('utf-8') for string in column.strings]
+          offsets = array('q', [0])
+          for data in encoded:
+            offsets.append(offsets[-1] + len(data))
+          meta['size'] = len(encoded)
+          meta['index'] = self._block(fp, column.index.tobytes())
+          meta['offsets'] = self._block(fp, offsets.tobytes())
+          meta['data'] = self._block(fp, b''.join(encoded))
+        columns.append(meta)
+      meta = json.dumps({
+        'version': VERSION,
+        'byteorder': sys.byteorder,
+        'key': self.key,
+        'header': self.header,
+        'count': self.count,
+        'columns': columns
+      }, ensure_ascii=False).encode('utf-8')
+      meta_offset = fp.tell()
+      fp.write(meta)
+      fp.write(TRAILER.pack(meta_offset, len(meta), MAGIC))
+    os.replace(self.partial_path, self.path)
+
+  def abort(self):
+    self.closed = True
+    if os.path.exists(self.partial_path):
+      os.remove(self.partial_path)
+
+class _Column(object):
+  def __init__(self, buffer, meta):
+    self.name = meta['name']
+    self.type = meta['type']
+    if self.type == 'int':
+      self.values = self._view(buffer, meta['values'], 'q')
+    else:
+      self.index = self._view(buffer, meta['index'], 'i')
+      self.offsets = self._view(buffer, meta['offsets'], 'q')
+      offset, size = meta['data']
+      self.data = buffer[offset:offset + size]
+
+  def _view(self, buffer, block, fmt):
+    offset, size = block
+    return buffer[offset:offset + size].cast(fmt)
+
+  def get(self, position):
+    if self.type == 'int':
+      return self.values[position]
+    index = self.index[position]
+    value = str(self.data[self.offsets[index]:self.offsets[index +1]], 'utf-8')
+    return value if self.type == 'str' else json.loads(value)
+
+class _MappedFile(object):
+  def __init__(self, path):
+    with open(path, 'rb') as fp:
+      size = os.fstat(fp.fileno()).st_size
+      if size < len(MAGIC) + TRAILER.size:
+        raise ValueError('Not an elb dataset: {}'.format(path))
+      self.map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    buffer = memoryview(self.map)
+    meta_offset, meta_size, magic = TRAILER.unpack(buffer[size - TRAILER.size:])
+    if buffer[:len(MAGIC)] != MAGIC or magic != MAGIC:
+      raise ValueError('Not an elb dataset: {}'.format(path))
+    meta = json.loads(str(buffer[meta_offset:meta_offset + meta_size], 'utf-8'))
+    if meta['version'] != VERSION or meta['byteorder'] != sys.byteorder:
+      raise ValueError('Unsupported elb dataset (version {}, {} endian): {}'.format(
+        meta['version'], meta['byteorder'], path))
+    self.key = meta['key']
+    self.header = meta['header']
+    self.count = meta['count']
+    self.columns = [_Column(buffer, column) for column in meta['columns']]
+
+# files mapped by this process, shared by every view over them
+_mapped = {}
+
+def _open(path):
+  stat = os.stat(path)
+  key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+  mapped = _mapped.get(key)
+  if mapped is None:
+    mapped = _mapped[key] = _MappedFile(path)
+  return mapped
+
+class BinaryDataset(object):
+  """Lazy sequence of the records of an .elb dataset (or of the
+  [start, stop) range of them), `dataset[a:b]` is another view"""
+  def __init__(self, path, start=0, stop=None):
+    self.path = path
+    self.file = _open(path)
+    self.start = start
+    self.stop = self.file.count if stop is None else stop
+    self.header = self.file.header
+    self.key = self.file.key
+
+  def __reduce__(self):
+    # workers map the file on their own
+    return (BinaryDataset, (self.path, self.start, self.stop))
+
+  def __len__(self):
+    return self.stop - self.start
+
+  def __getitem__(self, item):
+    if isinstance(item, slice):
+      start, stop, step = item.indices(len(self))
+      if step != 1:
+        raise ValueError('Only contiguous slices of a dataset are supported')
+      return BinaryDataset(self.path, self.start + start, self.start + max(start, stop))
+    if item < 0:
+      item += len(self)
+    if not 0 <= item < len(self):
+      raise IndexError('Record index out of range')
+    position = self.start + item
+    return { column.name: column.get(position) for column in self.file.columns }
+
+  def __iter__(self):
+    columns = self.file.columns
+    for position in range(self.start, self.stop):
+      yield { column.name: column.get(position) for column in columns }
+
+  def column(self, name):
+    """Values of a column, int columns are a zero copy memoryview"""
+    for column in self.file.columns:
+      if column.name == name:
+        if column.type == 'int':
+          return column.values[self.start:self.stop]
+        return [column.get(position) for position in range(self.start, self.stop)]
+    raise KeyError(name)
+
+  def slices(self, size):
+    for start in range(0, len(self), size):
+      yield self[start:start + size]
+
+def convert(input_path, output_path):
+  """Copy a dataset into another format, chosen by the extensions"""
+  from el_io import open_records, DatasetWriter
+  reader, records = open_records(input_path)
+  with DatasetWriter(output_path, header=reader.header) as writer:
+    writer.write_all(records)
+  return writer.count
+
+def main(FLAGS):
+  count = convert(FLAGS.input, FLAGS.output)
+  print('Converted {} records, {} -> {} bytes'.format(count,
+    os.path.getsize(FLAGS.input), os.path.getsize(FLAGS.output)))
+
+if __name__ == '__main__':
+  FLAGS, unparsed = parser.parse_known_args()
+  main(FLAGS)
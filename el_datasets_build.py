@@ -13,7 +13,10 @@ Also, extract basic statistics about the dataset:
  Number of Questions, Questions with dbrs, Avg dbr per Question and Unique dbrs
 """
 
-from utils import clean_str
+from utils import clean_str, Deduper
+from el_io import read_records, batches, imap_bounded, DatasetWriter
+from el_sparql import resolve_prefixes
+from functools import partial
 
 __author__ = "Guillermo Echegoyen"
 __credits__ = ["Guillermo Echegoyen"]
@@ -24,9 +27,10 @@ __email__ = "gblanco@lsi.uned.es"
 __status__ = "Production"
 
 import re
-import json
 import argparse
 
+WORKER_BATCH_SIZE = 1000
+
 parser = argparse.ArgumentParser()
 parser.add_argument(
   '-d',
@@ -48,58 +52,117 @@ parser.add_argument(
   type=str,
   default=None,
   help='The output file to store the processed dataset.')
-
-FLAGS, unparsed = parser.parse_known_args()
+parser.add_argument(
+  '--dedup-db',
+  type=str,
+  default=None,
+  help='Keep seen questions in this sqlite file instead of memory (huge datasets).')
+parser.add_argument(
+  '--resolve-prefixes',
+  required=False,
+  dest='resolve_prefixes',
+  action='store_true',
+  default=False,
+  help='Expand PREFIX declarations of the queries before looking for dbrs (prefixed dbrs are missed otherwise).')
+parser.add_argument(
+  '-w',
+  '--workers',
+  type=int,
+  required=False,
+  default=1,
+  help='Number of processes extracting dbrs, ids and deduplication stay in order.')
 
 DBR_REG = re.compile('<(http://dbpedia.org/resource/[^>]+)>')
 
-def process_sparql(sparql_str):
+def process_sparql(sparql_str, resolve=False):
+  if resolve:
+    sparql_str = resolve_prefixes(sparql_str)
   dbrs = DBR_REG.findall(sparql_str)
   return dbrs
 
-data = json.load(open(FLAGS.dataset, 'r'))
+def extract(eval_tuples, resolve=False, stats=False):
+  """(question, question id, dbrs, cleaned dbrs) of every QA datapoint,
+  cleaned dbrs are only computed for stats"""
+  extracted = []
+  for eval_tuple in eval_tuples:
+    question = eval_tuple['question'][0]['string']
+    dbrs = process_sparql(eval_tuple['query']['sparql'], resolve=resolve)
+    clean_dbrs = [clean_str(dbr) for dbr in dbrs] if stats else None
+    extracted.append((question, eval_tuple['id'], dbrs, clean_dbrs))
+  return extracted
+
+def extract_dataset(eval_tuples, resolve=False, stats=False, workers=1):
+  extract_fn = partial(extract, resolve=resolve, stats=stats)
+  if workers > 1:
+    from multiprocessing import Pool
+    pool = Pool(processes=workers)
+    try:
+      for extracted in imap_bounded(pool, extract_fn, batches(eval_tuples, WORKER_BATCH_SIZE),
+          workers * 2):
+        for item in extracted:
+          yield item
+    finally:
+      pool.close()
+      pool.join()
+  else:
+    for eval_tuple in eval_tuples:
+      for item in extract_fn([eval_tuple]):
+        yield item
+
+def main(FLAGS):
+  output_dataset = None
+  if FLAGS.output is not None:
+    output_dataset = DatasetWriter(FLAGS.output)
 
-# stats:
-# #Q, #Q with dbrs, #Avg #dbr per Q, #Unique dbrs
-questions_with_dbr = []
-unique_dbrs = []
-avg_dbrs_question = []
+  # stats:
+  # #Q, #Q with dbrs, #Avg #dbr per Q, #Unique dbrs
+  n_questions_with_dbr = 0
+  n_dbrs = 0
+  unique_dbrs = set()
 
-unique_questions = []
-output_questions = []
-for eval_tuple in data['questions']:
+  unique_questions = Deduper(FLAGS.dedup_db)
+  n_questions = 0
+  n_output_questions = 0
   try:
-    question = eval_tuple['question'][0]['string']
-    dbrs = process_sparql(eval_tuple['query']['sparql'])
-    # filter repeated questions
-    if len(dbrs):
-      # stats
-      questions_with_dbr.append(question)
-      avg_dbrs_question.append(len(dbrs))
-      for dbr in dbrs:
-        d = clean_str(dbr)
-        if d not in unique_dbrs:
-          unique_dbrs.append(d)
-      # dataset build
-      if question not in unique_questions:
-        unique_questions.append(question)
-        for dbr in dbrs:
-          datapoint = {
-            'id': len(output_questions) +1,
-            'question_id': int(eval_tuple['id']),
-            'question': question,
-            'dbr': dbr
-          }
-          output_questions.append(datapoint)
+    for question, question_id, dbrs, clean_dbrs in extract_dataset(read_records(FLAGS.dataset),
+        resolve=FLAGS.resolve_prefixes, stats=FLAGS.stats, workers=FLAGS.workers):
+      n_questions += 1
+      # filter repeated questions
+      if len(dbrs):
+        # stats
+        n_questions_with_dbr += 1
+        n_dbrs += len(dbrs)
+        if clean_dbrs is not None:
+          unique_dbrs.update(clean_dbrs)
+        # dataset build
+        if unique_questions.add(question):
+          for dbr in dbrs:
+            datapoint = {
+              'id': n_output_questions +1,
+              'question_id': int(question_id),
+              'question': question,
+              'dbr': dbr
+            }
+            n_output_questions += 1
+            if output_dataset is not None:
+              output_dataset.write(datapoint)
   except Exception as e:
+    if output_dataset is not None:
+      output_dataset.abort()
     raise e
+  finally:
+    unique_questions.close()
+
+  if output_dataset is not None:
+    output_dataset.close()
 
-if FLAGS.output is not None:
-  json.dump(fp=open(FLAGS.output, 'w'), obj={ 'questions': output_questions }, ensure_ascii=False)
+  if FLAGS.stats:
+    print('Dataset: {}'.format(FLAGS.dataset))
+    print('-> Questions: {}'.format(n_questions))
+    print('-> Questions with dbr {}'.format(n_questions_with_dbr))
+    print('-> Avg #dbr per Question {:.2f}'.format(n_dbrs/max(1, n_questions_with_dbr)))
+    print('-> Unique dbrs {}'.format(len(unique_dbrs)))
 
-if FLAGS.stats:
-  print('Dataset: {}'.format(FLAGS.dataset))
-  print('-> Questions: {}'.format(len(data['questions'])))
-  print('-> Questions with dbr {}'.format(len(questions_with_dbr)))
-  print('-> Avg #dbr per Question {:.2f}'.format(sum(avg_dbrs_question)/len(questions_with_dbr)))
-  print('-> Unique dbrs {}'.format(len(unique_dbrs)))
\ No newline at end of file
+if __name__ == '__main__':
+  FLAGS, unparsed = parser.parse_known_args()
+  main(FLAGS)
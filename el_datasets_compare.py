@@ -4,9 +4,20 @@
 
 Given two or more QA datasets, compare it's mention field
 and output the result to a new file.
+
+Datapoints are joined on (id, question_id), so datasets may be in any
+order and only partially overlap (datapoints missing from some dataset
+are counted, not compared). By default every dataset but the first is
+kept in a hash table of mentions while the first one is streamed, with
+--join merge all of them are streamed together, which needs them sorted
+by (id, question_id), as el_benchmark outputs are. Along the way, the
+agreement between every pair of datasets is counted, --agreement prints
+it as a matrix.
 """
 
 from os.path import dirname, basename, splitext, abspath
+from el_io import read_records, DatasetWriter
+from collections import Counter
 
 __author__ = "Guillermo Echegoyen"
 __credits__ = ["Guillermo Echegoyen"]
@@ -17,7 +28,6 @@ __email__ = "gblanco@lsi.uned.es"
 __status__ = "Production"
 
 import sys
-import json
 import argparse
 
 parser = argparse.ArgumentParser()
@@ -35,51 +45,176 @@ parser.add_argument(
     required=False,
     default=None,
     help='Output path to place the results.')
+parser.add_argument(
+    '--join',
+    '-j',
+    type=str,
+    required=False,
+    choices=['hash', 'merge'],
+    default='hash',
+    help='hash: any order, keeps the mentions of all datasets but the first in memory. '
+      'merge: streams every dataset, which must be sorted by (id, question_id).')
+parser.add_argument(
+    '--agreement',
+    '-a',
+    required=False,
+    dest='agreement',
+    action='store_true',
+    default=False,
+    help='Print the agreement matrix between datasets.')
+
+def get_key(datapoint):
+  return (datapoint['id'], datapoint['question_id'])
+
+# no mention from a dataset yet
+_MISSING = object()
+
+def _count_missing(mentions, missing):
+  for index, mention in enumerate(mentions):
+    if mention is not _MISSING:
+      missing[index +1] += 1
+
+def hash_join(datasets, missing):
+  """(datapoint of the first dataset, mentions of every dataset) for each
+  key in all of them, in the order of the first one. `missing[i]` counts
+  the datapoints of dataset i not found in some other"""
+  n_others = len(datasets) -1
+  table = {}
+  for index, dataset in enumerate(datasets[1:]):
+    for datapoint in dataset:
+      mentions = table.setdefault(get_key(datapoint), [_MISSING] * n_others)
+      if mentions[index] is not _MISSING:
+        raise ValueError('Duplicated datapoint {} in dataset {}'.format(get_key(datapoint), index +2))
+      mentions[index] = datapoint['mention']
+
+  for datapoint in datasets[0]:
+    mentions = table.pop(get_key(datapoint), None)
+    if mentions is None or _MISSING in mentions:
+      missing[0] += 1
+      if mentions is not None:
+        _count_missing(mentions, missing)
+      continue
+    yield datapoint, [datapoint['mention']] + mentions
+
+  # not in the first dataset
+  for mentions in table.values():
+    _count_missing(mentions, missing)
+
+def _sorted_records(dataset, index):
+  last = None
+  for datapoint in dataset:
+    key = get_key(datapoint)
+    if last is not None and not last < key:
+      raise ValueError('Dataset {} is not sorted by (id, question_id) at {}, '
+        'use --join hash'.format(index +1, key))
+    last = key
+    yield key, datapoint
+
+def merge_join(datasets, missing):
+  """Same as hash_join, for datasets sorted by key, streaming all"""
+  iters = [_sorted_records(dataset, index) for index, dataset in enumerate(datasets)]
+  heads = [next(records, None) for records in iters]
+  while None not in heads:
+    key = max(head[0] for head in heads)
+    if all(head[0] == key for head in heads):
+      yield heads[0][1], [head[1]['mention'] for head in heads]
+      heads = [next(records, None) for records in iters]
+      continue
+    # datapoints behind the greatest key are not in every dataset
+    for index, records in enumerate(iters):
+      while heads[index] is not None and heads[index][0] < key:
+        missing[index] += 1
+        heads[index] = next(records, None)
+  for index, records in enumerate(iters):
+    if heads[index] is not None:
+      missing[index] += 1 + sum(1 for _ in records)
+
+def mention_groups(mentions):
+  """Group of every mention, equal mentions share it"""
+  groups = {}
+  return tuple(groups.setdefault(mention, len(groups)) for mention in mentions)
+
+def agreement_matrix(patterns, n_datasets):
+  """Datapoints where each pair of datasets agree, out of the counts of
+  every pattern of mention groups"""
+  matrix = [[0] * n_datasets for _ in range(n_datasets)]
+  for pattern, count in patterns.items():
+    for index, group in enumerate(pattern):
+      for other in range(n_datasets):
+        if pattern[other] == group:
+          matrix[index][other] += count
+  return matrix
+
+def print_agreement(matrix, total, missing, paths):
+  print('Compared {} datapoints'.format(total))
+  for index, path in enumerate(paths):
+    print('d{}: {} ({} not in every dataset)'.format(index +1, path, missing[index]))
+  names = ['d{}'.format(index +1) for index in range(len(paths))]
+  print(' ' * 4 + ''.join('{:>10}'.format(name) for name in names))
+  for name, row in zip(names, matrix):
+    print('{:<4}'.format(name) + ''.join('{:>10.4f}'.format(agree / total if total else 0.0)
+      for agree in row))
+
+def main(FLAGS):
+  if len(FLAGS.dataset) < 2:
+    parser.error('Provide two datasets to compare!')
+
+  output = FLAGS.output
+  if output is None:
+    output = splitext(abspath(FLAGS.dataset[0]))[0] + '_processed.json'
+
+  datasets = []
+  for dataset_path in FLAGS.dataset:
+    datasets.append(read_records(abspath(dataset_path)))
+
+  n_datasets = len(datasets)
+  missing = [0] * n_datasets
+  join = merge_join if FLAGS.join == 'merge' else hash_join
+  # datapoints by pattern of mention groups, eg: (0, 1, 0) d1 and d3 agree
+  patterns = Counter()
+  output_dataset = None
+  try:
+    for datapoint, mentions in join(datasets, missing):
+      groups = mention_groups(mentions)
+      patterns[groups] += 1
+      if max(groups) == 0:
+        # all agree
+        continue
+      diffs = []
+      for index in range(n_datasets-1):
+        for left in range(index+1, n_datasets):
+          if groups[index] != groups[left]:
+            name = 'mention_d{}'.format(index+1)
+            diffs.append(( name, mentions[index] ))
+            name = 'mention_d{}'.format(left+1)
+            diffs.append(( name, mentions[left] ))
+
+      question = dict(id=datapoint['id'], question_id=datapoint['question_id'],
+          dbr=datapoint['dbr'], question=datapoint['question'])
+      for diff in diffs:
+        question[diff[0]] = diff[1]
+      if output_dataset is None:
+        # only written when there are differences
+        obj = dict()
+        for idx, dataset_path in enumerate(FLAGS.dataset):
+          obj['d{}'.format(idx+1)] = abspath(dataset_path)
+        output_dataset = DatasetWriter(output, header=obj)
+      output_dataset.write(question)
+  except Exception:
+    # eg: an unsorted dataset with --join merge, drop the partial output
+    if output_dataset is not None:
+      output_dataset.abort()
+    raise
+
+  if output_dataset is not None:
+    output_dataset.close()
+  else:
+    print('No differences!')
+
+  if FLAGS.agreement:
+    print_agreement(agreement_matrix(patterns, n_datasets), sum(patterns.values()), missing,
+      [abspath(dataset_path) for dataset_path in FLAGS.dataset])
 
-FLAGS, unparsed = parser.parse_known_args()
-
-if len(FLAGS.dataset) < 2:
-  parser.error('Provide two datasets to compare!')
-
-output = FLAGS.output
-if output is None:
-  output = splitext(abspath(FLAGS.dataset[0]))[0] + '_processed.json'
-
-datasets = []
-for dataset_path in FLAGS.dataset:
-  datasets.append(json.load(open(abspath(dataset_path), 'r'))['questions'])
-
-n_datasets = len(datasets)
-questions = []
-for data in zip(*datasets):
-  for index in range(n_datasets-1):
-    assert(data[index]['id'] == data[index+1]['id'])
-    assert(data[index]['question_id'] == data[index+1]['question_id'])
-  diffs = []
-  mentions = [d['mention'] for d in data]
-  for index in range(n_datasets-1):
-    mention_src = mentions[index]
-    for left in range(index+1, n_datasets):
-      if mention_src != mentions[left]:
-        name = 'mention_d{}'.format(index+1)
-        diffs.append(( name, mention_src ))
-        name = 'mention_d{}'.format(left+1)
-        diffs.append(( name, mentions[left] ))
-
-  if len(diffs):
-    question = dict(id=data[0]['id'], question_id=data[0]['question_id'],
-        dbr=data[0]['dbr'], question=data[0]['question'])
-    for diff in diffs:
-      question[diff[0]] = diff[1]
-    questions.append(question)
-
-if len(questions):
-  obj = dict()
-  for idx, dataset_path in enumerate(FLAGS.dataset):
-    obj['d{}'.format(idx+1)] = abspath(dataset_path)
-    
-  obj['questions'] = questions
-  
-  json.dump(fp=open(output, 'w'), obj=obj, ensure_ascii=False)
-else:
-  print('No differences!')
+if __name__ == '__main__':
+  FLAGS, unparsed = parser.parse_known_args()
+  main(FLAGS)
@@ -7,6 +7,8 @@ a single file avoiding repetitions.
 """
 
 from os.path import dirname, basename, splitext, abspath, join
+from el_io import read_records, DatasetWriter
+from utils import Deduper
 
 __author__ = "Guillermo Echegoyen"
 __credits__ = ["Guillermo Echegoyen"]
@@ -17,7 +19,6 @@ __email__ = "gblanco@lsi.uned.es"
 __status__ = "Production"
 
 import sys, os
-import json
 import argparse
 
 parser = argparse.ArgumentParser()
@@ -34,32 +35,43 @@ parser.add_argument(
     required=False,
     default=None,
     help='Output path to place the results.')
+parser.add_argument(
+    '--dedup-db',
+    type=str,
+    required=False,
+    default=None,
+    help='Keep seen questions in this sqlite file instead of memory (huge merges).')
 
-FLAGS, unparsed = parser.parse_known_args()
+def main(FLAGS):
+  output = FLAGS.output
+  if output is None:
+    output = splitext(abspath(FLAGS.dataset[0]))[0] + '_merged.json'
 
-output = FLAGS.output
-if output is None:
-  output = splitext(abspath(FLAGS.dataset[0]))[0] + '_merged.json'
+  datasets = []
+  for dataset_path in sorted(os.listdir(FLAGS.dir)):
+    datasets.append(read_records(abspath(join(FLAGS.dir, dataset_path))))
 
-datasets = []
-for dataset_path in os.listdir(FLAGS.dir):
-  datasets.append(json.load(open(abspath(join(FLAGS.dir, dataset_path)), 'r'))['questions'])
+  output_dataset = DatasetWriter(output, header={ 'dataset': { 'id': basename(output) } })
+  n_questions = 0
+  hashes = Deduper(FLAGS.dedup_db)
+  for dataset in datasets:
+    for datapoint in dataset:
+      question_str = datapoint['question']
+      question_dbr = datapoint['dbr']
+      question_hash = question_str + question_dbr
+      if hashes.add(question_hash):
+        question_out = {
+          'id': n_questions+1,
+          'question_id': datapoint['question_id'],
+          'question': question_str,
+          'dbr': question_dbr
+        }
+        n_questions += 1
+        output_dataset.write(question_out)
 
-questions = []
-hashes = []
-for dataset in datasets:
-  for datapoint in dataset:
-    question_str = datapoint['question']
-    question_dbr = datapoint['dbr']
-    question_hash = question_str + question_dbr
-    if question_hash not in hashes:
-      question_out = {
-        'id': len(questions)+1,
-        'question_id': datapoint['question_id'],
-        'question': question_str,
-        'dbr': question_dbr
-      }
-      questions.append(question_out)
+  output_dataset.close()
+  hashes.close()
 
-obj = { 'dataset': { 'id': basename(output) }, 'questions': questions }
-json.dump(fp=open(output, 'w'), obj=obj, ensure_ascii=False)
+if __name__ == '__main__':
+  FLAGS, unparsed = parser.parse_known_args()
+  main(FLAGS)
@@ -5,6 +5,11 @@
 Download, extract and convert any version of
 QALD or LC-QuAD datasets to a suitable format
 for EL Benchmark, conveting xml to json.
+
+Downloads run concurrently and are cached: a dataset is only fetched
+again when the server reports a change (ETag/Last-Modified), urls may
+point to a local mirror (--base-url, --lcquad-url). Xml is converted
+question by question, without loading the whole document.
 """
 
 __author__ = "Guillermo Echegoyen"
@@ -15,35 +20,49 @@ __maintainer__ = "Guillermo Echegoyen"
 __email__ = "gblanco@lsi.uned.es"
 __status__ = "Production"
 
-import sys, os, re, json
-import xmltodict
+from el_io import open_records, DatasetWriter
+from el_sparql import resolve_prefixes
+from concurrent.futures import ThreadPoolExecutor
+from xml.parsers import expat
+
+import os, json, shutil, argparse
 
-if sys.version_info.major == 2:
-  from urllib import urlretrieve as download
-else:
-  from urllib.request import urlretrieve as download
+parser = argparse.ArgumentParser()
+parser.add_argument(
+  '--dir',
+  type=str,
+  required=False,
+  default=None,
+  help='Where to place the datasets, defaults to ./datasets.')
+parser.add_argument(
+  '--base-url',
+  type=str,
+  required=False,
+  default='https://raw.githubusercontent.com/ag-sc/QALD/master',
+  help='QALD repository url (eg: a local mirror).')
+parser.add_argument(
+  '--lcquad-url',
+  type=str,
+  required=False,
+  default='https://ndownloader.figshare.com/files/10505914',
+  help='LC-QuAD dataset url.')
+parser.add_argument(
+  '-w',
+  '--workers',
+  type=int,
+  required=False,
+  default=4,
+  help='Number of concurrent downloads.')
+parser.add_argument(
+  '--timeout',
+  type=float,
+  required=False,
+  default=60,
+  help='Seconds to wait for a server.')
 
 def correct_sparql_query(key, value):
   return key, { 'sparql': resolve_prefixes(value) }
 
-# global prefix_def
-def resolve_prefixes(query):
-  global prefix_def
-  rest_query_lines = []
-  prefixes = []
-  for line in query.split('\n'):
-    if line.lower().startswith('prefix'):
-      prefixes.append(line)
-    else:
-      rest_query_lines.append(line)
-  rest_query = '\n'.join(rest_query_lines)
-  prefix_substitutions = list(map(lambda prefix: prefix_def.findall(prefix)[0], prefixes))
-  for sub, uri in prefix_substitutions:
-    r1 = r'{}:(\w+)'.format(sub)
-    r2 = r'<{}\1>'.format(uri)
-    rest_query = re.sub(r1, r2, rest_query)
-  return rest_query
-
 # global xml_path_subs
 def processor(path, key, value):
   global xml_path_subs
@@ -118,32 +137,114 @@ def monolingual_question(question):
   question['question'] = [{ 'string': question_value, 'language': 'en'}]
   return question
 
-def maybe_convert_to_json(file, multilingual=True):
+def read_root(file):
+  """Name and attributes of the root element of an xml file"""
+  root = []
+  def start_element(name, attrs):
+    root.extend([name, attrs])
+    # stop as soon as the root element is read
+    raise StopIteration
+  xml_parser = expat.ParserCreate()
+  xml_parser.StartElementHandler = start_element
+  with open(file, 'rb') as fp:
+    try:
+      xml_parser.ParseFile(fp)
+    except StopIteration:
+      pass
+  return tuple(root) if len(root) else (None, {})
+
+def convert_xml(file, json_file_name, multilingual=True):
+  # questions are parsed one at a time (item_depth=2) and streamed
+  # to the output, the whole xml is never in memory
+  import xmltodict
   full_basename = os.path.splitext(file)[0]
-  json_file_name = full_basename + '.json'
-  if file.endswith('xml') and not os.path.exists(json_file_name):
-    xml_parsed = xmltodict.parse(open(file, 'r').read(),
+  process_fn = multilingual_question if multilingual else monolingual_question
+  name, attrs = read_root(file)
+  dataset = { (key[1:] if key.startswith('@') else key): value for key, value in attrs.items() }
+  dataset['id'] = '{}_{}'.format(os.path.basename(full_basename), dataset['id'])
+
+  with DatasetWriter(json_file_name, header={ name: dataset }) as output:
+    def write_question(path, question):
+      # only questions live under the root, anything else is dropped
+      if path[-1][0] == 'question':
+        question = process_fn(question)
+        if question is not None:
+          output.write(question)
+      return True
+
+    with open(file, 'rb') as fp:
+      xmltodict.parse(fp, item_depth=2, item_callback=write_question,
         process_namespaces=True, postprocessor=processor)
-    questions = xml_parsed['dataset']['question']
-    del xml_parsed['dataset']['question']
-    xml_parsed['dataset']['id'] = '{}_{}'.format(
-      os.path.basename(full_basename), xml_parsed['dataset']['id'])
-    process_fn = multilingual_question if multilingual else monolingual_question
-    xml_parsed['questions'] = list(filter(lambda q: q is not None,
-      map(lambda q: process_fn(q), questions)))
-    json.dump(fp=open(json_file_name, 'w'), obj=xml_parsed, ensure_ascii=False)
 
+def filter_json(json_file_name):
+  # read and write are both streamed, the output replaces the input on close
+  reader, questions = open_records(json_file_name)
+  header = dict(reader.header)
+  with DatasetWriter(json_file_name, header=header) as output:
+    output.write_all(question for question in questions if check_keys(question) is not None)
+    # keys placed after the questions, if any
+    output.close(trailer={ key: value for key, value in reader.header.items() if key not in header })
+
+def maybe_convert_to_json(file, multilingual=True, force=False):
+  full_basename = os.path.splitext(file)[0]
+  json_file_name = full_basename + '.json'
+  if file.endswith('xml') and (force or not os.path.exists(json_file_name)):
+    convert_xml(file, json_file_name, multilingual=multilingual)
   else:
-    dataset = json.load(open(json_file_name, 'r'))
-    dataset['questions'] = list(filter(lambda q: check_keys(q) is not None, dataset['questions']))
-    json.dump(fp=open(json_file_name, 'w'), obj=dataset, ensure_ascii=False)
+    filter_json(json_file_name)
+
+def _http_cache_path(file):
+  return os.path.join(os.path.dirname(file), '.{}.http.json'.format(os.path.basename(file)))
+
+def download(url, file, timeout=60):
+  """Download `url` into `file`. Files downloaded before are only fetched
+  again when the server says they changed (ETag/Last-Modified), files
+  from elsewhere are kept. Returns whether `file` changed"""
+  from urllib.error import HTTPError, URLError
+  from urllib.request import Request, urlopen
+  cache_path = _http_cache_path(file)
+  headers = {}
+  if os.path.exists(file):
+    if not os.path.exists(cache_path):
+      return False
+    cache = json.load(open(cache_path, 'r'))
+    if cache.get('url') != url:
+      cache = {}
+    if cache.get('etag'):
+      headers['If-None-Match'] = cache['etag']
+    if cache.get('last_modified'):
+      headers['If-Modified-Since'] = cache['last_modified']
+
+  try:
+    response = urlopen(Request(url, headers=headers), timeout=timeout)
+  except HTTPError as error:
+    if error.code == 304:
+      # not modified
+      return False
+    raise
+  except URLError as error:
+    if not os.path.exists(file):
+      raise
+    print('Warning! Could not check {} ({}), keeping {}'.format(url, error.reason, file))
+    return False
+
+  partial = os.path.join(os.path.dirname(file), '.{}.partial'.format(os.path.basename(file)))
+  with response, open(partial, 'wb') as fp:
+    shutil.copyfileobj(response, fp)
+    cache = {
+      'url': url,
+      'etag': response.headers.get('ETag'),
+      'last_modified': response.headers.get('Last-Modified')
+    }
+  os.replace(partial, file)
+  json.dump(fp=open(cache_path, 'w'), obj=cache)
+  return True
 
-def maybe_download(url, file, multilingual=True):
-  if not os.path.exists(file):
-    download(url, file)
-  maybe_convert_to_json(file, multilingual)
+def maybe_download(url, file, multilingual=True, timeout=60):
+  changed = download(url, file, timeout=timeout)
+  # a new xml must be converted again
+  maybe_convert_to_json(file, multilingual, force=changed)
 
-base_url = 'https://raw.githubusercontent.com/ag-sc/QALD/master'
 monolingual_indexes = [0, 1]
 # 1, 2 are monolingual, processing step is okay
 # 3, 4, 5 are multilingual
@@ -156,32 +257,44 @@ qald_uris = [
   ('qald-6-test-multilingual.json', True)
 ]
 
-lcquad_url = 'https://ndownloader.figshare.com/files/10505914'
 lcquad_name = 'LC-QuAD_v1.json'
 
-datasets = []
-for index, (qald_uri, multilingual) in enumerate(qald_uris):
-  target = index +1
-  name = 'QALD_{}{}'.format(target, os.path.splitext(qald_uri)[1])
-  url = '{}/{}/data/{}'.format(base_url, target, qald_uri)
-  datasets.append((name, url, multilingual))
-
-datasets.append((lcquad_name, lcquad_url, True))
-
-prefix_def = re.compile('PREFIX ([^:]+):\s*<([^>]+)>')
 xml_path_subs = {
   'dataset.question.query': correct_sparql_query
 }
 
-datasets_dir = os.path.join(os.getcwd(), 'datasets')
+def get_datasets(base_url, lcquad_url):
+  datasets = []
+  for index, (qald_uri, multilingual) in enumerate(qald_uris):
+    target = index +1
+    name = 'QALD_{}{}'.format(target, os.path.splitext(qald_uri)[1])
+    url = '{}/{}/data/{}'.format(base_url, target, qald_uri)
+    datasets.append((name, url, multilingual))
+
+  datasets.append((lcquad_name, lcquad_url, True))
+  return datasets
+
+def main(FLAGS):
+  datasets_dir = FLAGS.dir
+  if datasets_dir is None:
+    datasets_dir = os.path.join(os.getcwd(), 'datasets')
 
-if not os.path.exists(datasets_dir):
-  os.mkdir(datasets_dir)
+  if not os.path.exists(datasets_dir):
+    os.mkdir(datasets_dir)
 
-# download & process datasets
-for dataset in datasets:
-  name, url, multilingual = dataset
-  file = os.path.join(datasets_dir, name)
-  print('{} -> {}'.format(name, url))
-  maybe_download(url, file, multilingual=multilingual)
+  # download & process datasets, concurrently
+  with ThreadPoolExecutor(max_workers=max(1, FLAGS.workers)) as executor:
+    jobs = []
+    for dataset in get_datasets(FLAGS.base_url, FLAGS.lcquad_url):
+      name, url, multilingual = dataset
+      file = os.path.join(datasets_dir, name)
+      print('{} -> {}'.format(name, url))
+      jobs.append(executor.submit(maybe_download, url, file,
+        multilingual=multilingual, timeout=FLAGS.timeout))
+    # raise the first error, if any
+    for job in jobs:
+      job.result()
 
+if __name__ == '__main__':
+  FLAGS, unparsed = parser.parse_known_args()
+  main(FLAGS)
@@ -8,6 +8,7 @@ number of samples.
 """
 
 from utils import clean_str
+from el_io import read_records
 from collections import defaultdict
 
 __author__ = "Guillermo Echegoyen"
@@ -18,21 +19,19 @@ __maintainer__ = "Guillermo Echegoyen"
 __email__ = "gblanco@lsi.uned.es"
 __status__ = "Production"
 
-import json
 import sys
 
 if len(sys.argv) < 2:
   print('Usage dataset_stats.py <dataset>')
   sys.exit(0)
 
-# allow raise error
-data = json.load(open(sys.argv[1], 'r'))
-samples = data['questions']
-
 unique_questions = defaultdict(int)
 unique_entities = defaultdict(int)
+n_samples = 0
 
-for sample in samples:
+# allow raise error
+for sample in read_records(sys.argv[1]):
+  n_samples += 1
   question = clean_str(sample['question'])
   dbr = clean_str(sample['dbr'])
   unique_questions[question] +=1
@@ -40,4 +39,4 @@ for sample in samples:
 
 print('Unique Questions {}'.format(len(unique_questions)))
 print('Unique Entities {}'.format(len(unique_entities)))
-print('Total Samples {}'.format(len(samples)))
+print('Total Samples {}'.format(n_samples))
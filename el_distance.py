@@ -0,0 +1,80 @@
+"""Levenshtein distance for EL mention Benchmark
+
+Bit-parallel edit distance (Myers/Hyyro), the pattern (usually the
+dbr) is preprocessed once into per-character bit masks and reused to
+compare it against every candidate mention. A maximum distance may be
+given, then computation stops as soon as it can not be reached.
+"""
+
+from functools import lru_cache
+
+__author__ = "Guillermo Echegoyen"
+__credits__ = ["Guillermo Echegoyen"]
+__license__ = "GPL v3"
+__version__ = "1.0.0"
+__maintainer__ = "Guillermo Echegoyen"
+__email__ = "gblanco@lsi.uned.es"
+__status__ = "Production"
+
+
+class Levenshtein(object):
+  def __init__(self, pattern):
+    self.pattern = pattern
+    self.size = len(pattern)
+    self.full = (1 << self.size) - 1
+    self.last = 1 << (self.size - 1) if self.size else 0
+    self.peq = {}
+    for index, char in enumerate(pattern):
+      self.peq[char] = self.peq.get(char, 0) | (1 << index)
+
+  def distance(self, text, max_dist=None):
+    """Edit distance between the pattern and `text`, when it is
+    greater than `max_dist`, max_dist +1 is returned instead"""
+    text_size = len(text)
+    if max_dist is not None and abs(self.size - text_size) > max_dist:
+      # out of the band, can not get below max_dist
+      return max_dist +1
+    if self.size == 0:
+      return text_size
+    peq = self.peq
+    full = self.full
+    last = self.last
+    pv = full
+    mv = 0
+    score = self.size
+    for index, char in enumerate(text):
+      eq = peq.get(char, 0)
+      xv = eq | mv
+      xh = ((((eq & pv) + pv) & full) ^ pv) | eq
+      ph = mv | (~(xh | pv) & full)
+      mh = pv & xh
+      if ph & last:
+        score += 1
+      elif mh & last:
+        score -= 1
+      if max_dist is not None and score - (text_size - index -1) > max_dist:
+        # remaining chars can lower the score by one at most each
+        return max_dist +1
+      ph = ((ph << 1) | 1) & full
+      mh = (mh << 1) & full
+      pv = mh | (~(xv | ph) & full)
+      mv = ph & xv
+    return score
+
+@lru_cache(maxsize=4096)
+def get_levenshtein(pattern):
+  return Levenshtein(pattern)
+
+def edit_distance(s1, s2, max_dist=None):
+  return get_levenshtein(s2).distance(s1, max_dist=max_dist)
+
+def max_distance(metric, size):
+  """Greatest edit distance `dist` such that dist / size <= metric"""
+  max_dist = int(metric * size)
+  while (max_dist +1) / size <= metric:
+    max_dist += 1
+  while max_dist >= 0 and max_dist / size > metric:
+    max_dist -= 1
+  return max_dist
+
+__all__ = [ Levenshtein, get_levenshtein, edit_distance, max_distance ]
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+"""DBpedia resource table for EL mention Benchmark
+
+Everything the matchers and the evaluation derive from a dbr alone,
+computed once per resource instead of once per datapoint: its cleaned
+label (clean_str), the label the evaluation compares against
+(clean_str of the lowered uri), its tokens and its trigrams, as ids
+into a shared trigram vocabulary. The table is built from EL datasets
+and saved as json, el_benchmark --entities loads it on first use.
+Resources missing from it (or every resource, without a table) are
+computed when needed and kept in a cache of ENTITY_CACHE_SIZE entries,
+so a long running process (eg: el_server) does not grow with them.
+
+Usage:
+  el_entities.py -o entities.json -d datasets_el/QALD_1.json [-d ...]
+"""
+
+from utils import clean_str, str_to_trigrams_dict
+from functools import lru_cache
+
+__author__ = "Guillermo Echegoyen"
+__credits__ = ["Guillermo Echegoyen"]
+__license__ = "GPL v3"
+__version__ = "1.0.0"
+__maintainer__ = "Guillermo Echegoyen"
+__email__ = "gblanco@lsi.uned.es"
+__status__ = "Production"
+
+import os
+import json
+import argparse
+
+# entities out of the table
+ENTITY_CACHE_SIZE = 2 ** 16
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+  '-d',
+  '--dataset',
+  type=str,
+  required=True,
+  action='append',
+  help='EL datasets whose dbrs go into the table (repeatable).')
+parser.add_argument(
+  '-o',
+  '--output',
+  type=str,
+  required=True,
+  help='Table file (json).')
+
+class Entity(object):
+  __slots__ = ('label', 'eval_label', 'tokens', 'trigrams')
+
+  def __init__(self, label, eval_label, tokens, trigrams):
+    # clean_str(dbr), what the matchers work on
+    self.label = label
+    # clean_str(dbr.lower()), what evaluate_from_dbr compares against
+    self.eval_label = eval_label
+    self.tokens = tokens
+    # str_to_trigrams_dict(label.lower()) keys
+    self.trigrams = trigrams
+
+@lru_cache(maxsize=ENTITY_CACHE_SIZE)
+def compute_entity(dbr):
+  """Entity of a dbr without a table, the same EntityTable.get gives"""
+  label = clean_str(dbr)
+  return Entity(label, clean_str(dbr.lower()), tuple(label.split(' ')),
+    frozenset(str_to_trigrams_dict(label.lower())))
+
+class EntityTable(object):
+  def __init__(self):
+    self.vocab = []
+    self.gram_ids = {}
+    # dbr -> [label, eval label, tokens, trigram ids], as saved
+    self.rows = {}
+    # dbr -> Entity, decoded on first use
+    self.entities = {}
+
+  def __len__(self):
+    return len(self.rows)
+
+  def add(self, dbr):
+    if dbr in self.rows:
+      return self.rows[dbr]
+    label = clean_str(dbr)
+    gram_ids = []
+    for gram in str_to_trigrams_dict(label.lower()):
+      gram_id = self.gram_ids.get(gram)
+      if gram_id is None:
+        gram_id = self.gram_ids[gram] = len(self.vocab)
+        self.vocab.append(gram)
+      gram_ids.append(gram_id)
+    row = self.rows[dbr] = [label, clean_str(dbr.lower()), label.split(' '), sorted(gram_ids)]
+    return row
+
+  def get(self, dbr):
+    entity = self.entities.get(dbr)
+    if entity is None:
+      row = self.rows.get(dbr)
+      if row is None:
+        # not in the table, not kept in it either
+        return compute_entity(dbr)
+      label, eval_label, tokens, gram_ids = row
+      vocab = self.vocab
+      entity = self.entities[dbr] = Entity(label, eval_label, tuple(tokens),
+        frozenset(vocab[gram_id] for gram_id in gram_ids))
+    return entity
+
+  def save(self, path):
+    partial = path + '.partial'
+    json.dump(fp=open(partial, 'w'), obj={ 'vocab': self.vocab, 'entities': self.rows },
+      ensure_ascii=False)
+    os.replace(partial, path)
+
+  @classmethod
+  def load(cls, path):
+    data = json.load(open(path, 'r'))
+    table = cls()
+    table.vocab = data['vocab']
+    table.gram_ids = { gram: gram_id for gram_id, gram in enumerate(table.vocab) }
+    table.rows = data['entities']
+    return table
+
+# table of get_entity, loaded on first use
+_table = None
+_table_path = None
+
+def use_table(path):
+  """Take entities from the table at `path` (None for none)"""
+  global _table, _table_path
+  _table_path = path
+  _table = None
+  compute_entity.cache_clear()
+
+def table_path():
+  return _table_path
+
+def get_table():
+  global _table
+  if _table is None:
+    _table = EntityTable() if _table_path is None else EntityTable.load(_table_path)
+  return _table
+
+def get_entity(dbr):
+  return get_table().get(dbr)
+
+def main(FLAGS):
+  from el_io import read_records
+  table = EntityTable()
+  for path in FLAGS.dataset:
+    for record in read_records(path):
+      table.add(record['dbr'])
+  table.save(FLAGS.output)
+  print('{} entities, {} trigrams'.format(len(table), len(table.vocab)))
+
+if __name__ == '__main__':
+  FLAGS, unparsed = parser.parse_known_args()
+  main(FLAGS)
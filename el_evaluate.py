@@ -1,6 +1,7 @@
 """Perform evaluation over QA-EL dataset for EL mention
 Benchmark"""
 
+from el_entities import get_entity
 from utils import clean_str, find_question
 
 __author__ = "Guillermo Echegoyen"
@@ -11,10 +12,12 @@ __maintainer__ = "Guillermo Echegoyen"
 __email__ = "gblanco@lsi.uned.es"
 __status__ = "Production"
 
+import json
+
 
 def evaluate_from_dbr(eval_tuple):
   question = clean_str(eval_tuple['mention'].lower())
-  dbr = clean_str(eval_tuple['dbr'].lower())
+  dbr = get_entity(eval_tuple['dbr']).eval_label
   return question == dbr
 
 def evaluate_from_annotation(eval_tuple, annot_tuple):
@@ -23,8 +26,21 @@ def evaluate_from_annotation(eval_tuple, annot_tuple):
   return m1 == m2
 
 def evaluate_from_annotation_set(eval_tuple, annotations):
+  # annotations may be a QuestionIndex, build it once to evaluate many tuples
   annotation = find_question(eval_tuple, annotations)
   assert(annotation is not None)
   return evaluate_from_annotation(eval_tuple, annotation)
 
-__all__ = [ evaluate_from_dbr, evaluate_from_annotation, evaluate_from_annotation_set ]
+def read_annotations(path):
+  """Annotated datapoints and error buckets of an annotations file,
+  either a list of datapoints (annotations/*.json) or
+  `{"total": {"annotated": [...], "errors": {...}}}`"""
+  data = json.load(open(path, 'r'))
+  if isinstance(data, list):
+    return data, {}
+  if 'total' in data:
+    return data['total']['annotated'], data['total'].get('errors', {})
+  return data['questions'], {}
+
+__all__ = [ evaluate_from_dbr, evaluate_from_annotation, evaluate_from_annotation_set,
+  read_annotations ]
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+"""Inverted trigram index over dbrs for EL mention Benchmark
+
+The matcher answers where a known dbr is mentioned in a question, this
+index answers the reverse: which dbrs, out of many, are mentioned in a
+question. Every dbr is tokenized as the trigram method does and each
+trigram points to the dbrs containing it. Candidates of a question are
+the dbrs for which some question token scores over the threshold (the
+`MentionSet.prob_thr` by default), exactly the dbrs the trigram method
+finds a mention for without falling back to its best guess. Only the
+candidates are fed to `match_by_trigrams`.
+
+Usage:
+  el_index.py -i index.json -l labels.txt [-l dataset.json ...]
+  el_index.py -i index.json -q "question" [-q ...]
+"""
+
+from el_io import read_records
+from el_process import match_by_trigrams
+from utils import clean_str, str_to_trigrams_dict, tokenize_question, MentionSet
+from collections import Counter
+
+__author__ = "Guillermo Echegoyen"
+__credits__ = ["Guillermo Echegoyen"]
+__license__ = "GPL v3"
+__version__ = "1.0.0"
+__maintainer__ = "Guillermo Echegoyen"
+__email__ = "gblanco@lsi.uned.es"
+__status__ = "Production"
+
+import os
+import sys
+import json
+import argparse
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+  '-i',
+  '--index',
+  type=str,
+  required=True,
+  help='Index file (json), built with --labels, queried otherwise.')
+parser.add_argument(
+  '-l',
+  '--labels',
+  type=str,
+  required=False,
+  action='append',
+  default=None,
+  help='dbrs to index: text file with one per line or EL dataset (repeatable).')
+parser.add_argument(
+  '-q',
+  '--question',
+  type=str,
+  required=False,
+  action='append',
+  default=None,
+  help='Question to find dbrs for (repeatable), read from stdin otherwise.')
+parser.add_argument(
+  '-t',
+  '--threshold',
+  type=float,
+  required=False,
+  default=MentionSet.prob_thr,
+  help='Minimum trigram overlap of a question token (exclusive).')
+
+def min_common(size, threshold):
+  """Least common trigrams `common` such that common / size > threshold"""
+  common = int(threshold * size) +1
+  while common > 0 and (common -1) / size > threshold:
+    common -= 1
+  while common / size <= threshold:
+    common += 1
+  return common
+
+class TrigramIndex(object):
+  def __init__(self):
+    self.dbrs = []
+    # trigram -> ids of the dbrs that contain it, in increasing order
+    self.postings = {}
+    # trigrams of every dbr
+    self.grams = []
+
+  def __len__(self):
+    return len(self.dbrs)
+
+  def add(self, dbr):
+    """Index `dbr` (uri or label), returns its id"""
+    dbr_id = len(self.dbrs)
+    # same as match_by_trigrams(clean_str(dbr), ...)
+    grams = frozenset(str_to_trigrams_dict(clean_str(dbr).lower()))
+    for gram in grams:
+      self.postings.setdefault(gram, []).append(dbr_id)
+    self.dbrs.append(dbr)
+    self.grams.append(grams)
+    return dbr_id
+
+  def add_all(self, dbrs):
+    for dbr in dbrs:
+      self.add(dbr)
+
+  def save(self, path):
+    partial = path + '.partial'
+    json.dump(fp=open(partial, 'w'), obj={ 'dbrs': self.dbrs, 'postings': self.postings },
+      ensure_ascii=False)
+    os.replace(partial, path)
+
+  @classmethod
+  def load(cls, path):
+    data = json.load(open(path, 'r'))
+    index = cls()
+    index.dbrs = data['dbrs']
+    index.postings = data['postings']
+    grams = [set() for _ in index.dbrs]
+    for gram, dbr_ids in index.postings.items():
+      for dbr_id in dbr_ids:
+        grams[dbr_id].add(gram)
+    index.grams = [frozenset(dbr_grams) for dbr_grams in grams]
+    return index
+
+  def _token_candidates(self, grams, threshold):
+    # ids of the dbrs whose overlap with the token is over threshold
+    size = max(1, len(grams))
+    needed = min_common(size, threshold)
+    weights = Counter(grams)
+    if needed > len(grams):
+      return set()
+    # a dbr missing every trigram of the prefix (rarest first) can not
+    # reach `needed` with the remaining ones
+    remaining = len(grams)
+    prefix = []
+    for gram in sorted(weights, key=lambda gram: len(self.postings.get(gram, ()))):
+      if remaining < needed:
+        break
+      prefix.append(gram)
+      remaining -= weights[gram]
+    found = set()
+    for gram in prefix:
+      for dbr_id in self.postings.get(gram, ()):
+        if dbr_id in found:
+          continue
+        dbr_grams = self.grams[dbr_id]
+        common = sum(weight for gram, weight in weights.items() if gram in dbr_grams)
+        if common >= needed:
+          found.add(dbr_id)
+    return found
+
+  def candidates(self, question, threshold=MentionSet.prob_thr):
+    """Ids of the dbrs with a token of `question` over threshold"""
+    words_trigrams = tokenize_question(clean_str(question))[2]
+    found = set()
+    for grams in set(words_trigrams):
+      found.update(self._token_candidates(grams, threshold))
+    return sorted(found)
+
+  def match(self, question, threshold=MentionSet.prob_thr):
+    """(dbr, mention) of every candidate dbr of `question`"""
+    cleaned = clean_str(question)
+    return [(self.dbrs[dbr_id], match_by_trigrams(clean_str(self.dbrs[dbr_id]), cleaned))
+      for dbr_id in self.candidates(question, threshold=threshold)]
+
+def read_labels(path):
+  if path.endswith('.txt'):
+    with open(path, 'r') as fp:
+      for line in fp:
+        if line.strip():
+          yield line.strip()
+  else:
+    for record in read_records(path):
+      yield record['dbr']
+
+def main(FLAGS):
+  if FLAGS.labels is not None:
+    index = TrigramIndex()
+    seen = set()
+    for path in FLAGS.labels:
+      for dbr in read_labels(path):
+        if dbr not in seen:
+          seen.add(dbr)
+          index.add(dbr)
+    index.save(FLAGS.index)
+    print('Indexed {} dbrs, {} trigrams'.format(len(index), len(index.postings)))
+    return
+
+  index = TrigramIndex.load(FLAGS.index)
+  questions = FLAGS.question
+  if questions is None:
+    questions = (line.rstrip('\n') for line in sys.stdin if line.strip())
+  for question in questions:
+    matches = index.match(question, threshold=FLAGS.threshold)
+    print(json.dumps({
+      'question': question,
+      'candidates': [{ 'dbr': dbr, 'mention': mention } for dbr, mention in matches]
+    }, ensure_ascii=False))
+
+if __name__ == '__main__':
+  FLAGS, unparsed = parser.parse_known_args()
+  main(FLAGS)
@@ -0,0 +1,128 @@
+"""Per-stage timing of mention processing for EL mention Benchmark
+
+Counts calls and time spent in the stages of process(): text cleaning,
+tokenization, trigram scoring, mention search and trimming and the edit
+distance. Off by default, and without any cost then: enable() swaps the
+functions of each stage by timed wrappers (in the modules that call
+them) and disable() puts the originals back. Times are inclusive, eg:
+`dist` includes `edit_distance` and `MentionSet.reduce` its `align`.
+Only the calls made in this process are counted.
+"""
+
+from functools import wraps
+
+__author__ = "Guillermo Echegoyen"
+__credits__ = ["Guillermo Echegoyen"]
+__license__ = "GPL v3"
+__version__ = "1.0.0"
+__maintainer__ = "Guillermo Echegoyen"
+__email__ = "gblanco@lsi.uned.es"
+__status__ = "Production"
+
+import time
+import importlib
+
+# stage -> (module, attribute) pairs where its function is looked up
+STAGES = [
+  ('clean_str', [('el_process', 'clean_str'), ('el_evaluate', 'clean_str'),
+    ('el_entities', 'clean_str')]),
+  ('tokenize_question', [('el_process', 'tokenize_question')]),
+  ('overlap_trigrams_score', [('el_process', 'overlap_trigrams_score')]),
+  ('overlap_trigrams_set_score', [('el_process', 'overlap_trigrams_set_score')]),
+  ('score_pairs', [('el_process', '_score_pairs')]),
+  ('match_by_trigrams', [('el_process', 'match_by_trigrams')]),
+  ('simple_match', [('el_process', 'simple_match')]),
+  ('get_mentions_from_scores', [('el_process', 'get_mentions_from_scores')]),
+  ('MentionSet.reduce', [('utils', 'MentionSet.reduce')]),
+  ('MentionSet.align', [('utils', 'MentionSet.align')]),
+  ('dist', [('el_process', 'dist')]),
+  ('edit_distance', [('el_process', 'edit_distance')])
+]
+
+class StageStats(object):
+  __slots__ = ('name', 'calls', 'seconds')
+
+  def __init__(self, name):
+    self.name = name
+    self.calls = 0
+    self.seconds = 0.0
+
+def _timed(fn, stats):
+  perf_counter = time.perf_counter
+  @wraps(fn)
+  def timed(*args, **kwargs):
+    start = perf_counter()
+    try:
+      return fn(*args, **kwargs)
+    finally:
+      stats.calls += 1
+      stats.seconds += perf_counter() - start
+  return timed
+
+def _owner(module_name, path):
+  owner = importlib.import_module(module_name)
+  names = path.split('.')
+  for name in names[:-1]:
+    owner = getattr(owner, name)
+  return owner, names[-1]
+
+class Instrumentation(object):
+  def __init__(self):
+    self.stats = { name: StageStats(name) for name, _ in STAGES }
+    # (owner, attribute, original function) of every patched stage
+    self.patched = []
+
+  @property
+  def enabled(self):
+    return len(self.patched) > 0
+
+  def enable(self):
+    if self.enabled:
+      return
+    # batch scoring is only looked up on first use, resolve it now
+    importlib.import_module('el_process').get_score_pairs()
+    for name, targets in STAGES:
+      for module_name, path in targets:
+        owner, attribute = _owner(module_name, path)
+        original = getattr(owner, attribute, None)
+        if not callable(original):
+          continue
+        self.patched.append((owner, attribute, original))
+        setattr(owner, attribute, _timed(original, self.stats[name]))
+
+  def disable(self):
+    for owner, attribute, original in reversed(self.patched):
+      setattr(owner, attribute, original)
+    self.patched = []
+
+  def reset(self):
+    for stats in self.stats.values():
+      stats.calls = 0
+      stats.seconds = 0.0
+
+  def __enter__(self):
+    self.enable()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.disable()
+
+  def rows(self):
+    """Stats of the stages that were called, by stage order"""
+    return [self.stats[name] for name, _ in STAGES if self.stats[name].calls]
+
+  def table(self, total=None):
+    """Summary table, `total` seconds (eg: wall time) gives the share of
+    every stage"""
+    lines = ['{:<26} {:>10} {:>12} {:>10} {:>7}'.format('stage', 'calls', 'total ms',
+      'mean us', 'share')]
+    for stats in self.rows():
+      share = '{:>6.1%}'.format(stats.seconds / total) if total else '{:>6}'.format('-')
+      lines.append('{:<26} {:>10} {:>12.1f} {:>10.2f} {:>7}'.format(stats.name, stats.calls,
+        stats.seconds * 1000, stats.seconds / stats.calls * 1e6, share))
+    return '\n'.join(lines)
+
+# shared by the scripts
+instrumentation = Instrumentation()
+
+__all__ = [ STAGES, StageStats, Instrumentation, instrumentation ]
@@ -0,0 +1,258 @@
+"""Streaming input/output of QA-EL datasets
+
+Datasets are read and written one record at a time, so memory does not
+grow with the dataset size. Three layouts are supported:
+ - json: the usual `{"dataset": {...}, "questions": [...]}` object (or
+   a plain list of records), parsed incrementally
+ - jsonl: one record per line, chosen by the `.jsonl` extension
+ - elb: memory mapped binary columns (see el_binary), chosen by the
+   `.elb` extension
+"""
+
+import os
+import re
+import json
+
+from itertools import chain
+from collections import deque
+
+__author__ = "Guillermo Echegoyen"
+__credits__ = ["Guillermo Echegoyen"]
+__license__ = "GPL v3"
+__version__ = "1.0.0"
+__maintainer__ = "Guillermo Echegoyen"
+__email__ = "gblanco@lsi.uned.es"
+__status__ = "Production"
+
+WS_REG = re.compile('[ \t\n\r]*')
+CHUNK_SIZE = 1 << 16
+
+def is_jsonl(path):
+  return path.endswith('.jsonl')
+
+def is_binary(path):
+  return path.endswith('.elb')
+
+class _Scanner(object):
+  def __init__(self, fp, chunk_size=CHUNK_SIZE):
+    self.fp = fp
+    self.chunk_size = chunk_size
+    self.buffer = ''
+    self.pos = 0
+    self.eof = False
+    self.decoder = json.JSONDecoder()
+
+  def fill(self):
+    # read at least as much as pending, so a big value is read in
+    # a logarithmic number of steps
+    data = self.fp.read(max(self.chunk_size, len(self.buffer) - self.pos))
+    if not data:
+      self.eof = True
+    self.buffer = self.buffer[self.pos:] + data
+    self.pos = 0
+
+  def peek(self):
+    while True:
+      self.pos = WS_REG.match(self.buffer, self.pos).end()
+      if self.pos < len(self.buffer):
+        return self.buffer[self.pos]
+      if self.eof:
+        return ''
+      self.fill()
+
+  def expect(self, char):
+    found = self.peek()
+    if found != char:
+      raise ValueError('Expected {!r} at {!r}'.format(char, self.buffer[self.pos:self.pos+20]))
+    self.pos += 1
+
+  def value(self):
+    self.peek()
+    while True:
+      try:
+        obj, end = self.decoder.raw_decode(self.buffer, self.pos)
+        # a number at the end of the buffer may be cut
+        if end < len(self.buffer) or self.eof:
+          self.pos = end
+          return obj
+      except ValueError:
+        if self.eof:
+          raise
+      self.fill()
+
+class DatasetReader(object):
+  """Iterate over the records (`key` list) of a dataset.
+
+  Top level keys other than `key` are kept in `header`, only the ones
+  placed before the records are available while iterating them.
+  """
+  def __init__(self, path, key='questions'):
+    self.path = path
+    self.key = key
+    self.header = {}
+
+  def __iter__(self):
+    if is_binary(self.path):
+      from el_binary import BinaryDataset
+      dataset = BinaryDataset(self.path)
+      self.header.update(dataset.header)
+      for record in dataset:
+        yield record
+      return
+    with open(self.path, 'r') as fp:
+      if is_jsonl(self.path):
+        for line in fp:
+          if line.strip():
+            yield json.loads(line)
+      else:
+        for record in self._records(_Scanner(fp)):
+          yield record
+
+  def _list(self, scanner):
+    scanner.expect('[')
+    if scanner.peek() == ']':
+      scanner.pos += 1
+      return
+    while True:
+      yield scanner.value()
+      if scanner.peek() == ',':
+        scanner.pos += 1
+      else:
+        scanner.expect(']')
+        return
+
+  def _records(self, scanner):
+    if scanner.peek() == '[':
+      for record in self._list(scanner):
+        yield record
+      return
+    scanner.expect('{')
+    if scanner.peek() == '}':
+      return
+    while True:
+      key = scanner.value()
+      scanner.expect(':')
+      if key == self.key:
+        for record in self._list(scanner):
+          yield record
+      else:
+        self.header[key] = scanner.value()
+      if scanner.peek() == ',':
+        scanner.pos += 1
+      else:
+        scanner.expect('}')
+        return
+
+class DatasetWriter(object):
+  """Write records one at a time, output is the same as `json.dump` of
+  `header` plus the `key` records list (or one record per line for jsonl).
+
+  Records go to a hidden partial file, moved to `path` on close, so a
+  crashed run never leaves a truncated dataset behind. With `owner`
+  (eg: host.pid) in its name, several processes may write the same
+  dataset at once. Binary datasets are written by el_binary.BinaryWriter.
+  """
+  def __init__(self, path, header=None, key='questions', owner=None):
+    self.path = path
+    self.jsonl = is_jsonl(path)
+    self.binary = None
+    self.count = 0
+    if is_binary(path):
+      from el_binary import BinaryWriter
+      self.binary = BinaryWriter(path, header=header, key=key)
+      return
+    partial_name = os.path.basename(path) if owner is None else '{}.{}'.format(
+      os.path.basename(path), owner)
+    self.partial_path = os.path.join(os.path.dirname(path), '.{}.partial'.format(partial_name))
+    self.fp = open(self.partial_path, 'w')
+    if not self.jsonl:
+      self.fp.write('{')
+      for name, value in (header or {}).items():
+        self.fp.write('{}: {}, '.format(self._dumps(name), self._dumps(value)))
+      self.fp.write('{}: ['.format(self._dumps(key)))
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      self.close()
+    else:
+      self.abort()
+
+  def _dumps(self, obj):
+    return json.dumps(obj, ensure_ascii=False)
+
+  def write(self, record):
+    if self.binary is not None:
+      self.binary.write(record)
+    elif self.jsonl:
+      self.fp.write(self._dumps(record) + '\n')
+    else:
+      if self.count:
+        self.fp.write(', ')
+      self.fp.write(self._dumps(record))
+    self.count += 1
+
+  def write_all(self, records):
+    for record in records:
+      self.write(record)
+
+  def close(self, trailer=None):
+    """Finish the dataset, `trailer` keys are placed after the records"""
+    if self.binary is not None:
+      self.binary.close(trailer=trailer)
+      return
+    if self.fp.closed:
+      return
+    if not self.jsonl:
+      self.fp.write(']')
+      for name, value in (trailer or {}).items():
+        self.fp.write(', {}: {}'.format(self._dumps(name), self._dumps(value)))
+      self.fp.write('}')
+    self.fp.close()
+    os.replace(self.partial_path, self.path)
+
+  def abort(self):
+    if self.binary is not None:
+      self.binary.abort()
+      return
+    if self.fp.closed:
+      return
+    self.fp.close()
+    os.remove(self.partial_path)
+
+def read_records(path, key='questions'):
+  return iter(DatasetReader(path, key=key))
+
+def open_records(path, key='questions'):
+  """Start reading a dataset, returns its reader, with the header keys
+  placed before the records already loaded, and the records iterator"""
+  reader = DatasetReader(path, key=key)
+  records = iter(reader)
+  for first in records:
+    return reader, chain([first], records)
+  return reader, records
+
+def batches(records, size):
+  batch = []
+  for record in records:
+    batch.append(record)
+    if len(batch) == size:
+      yield batch
+      batch = []
+  if len(batch):
+    yield batch
+
+def imap_bounded(pool, fn, iterable, max_pending):
+  """Ordered pool.imap that only reads `max_pending` items ahead"""
+  pending = deque()
+  for item in iterable:
+    pending.append(pool.apply_async(fn, (item,)))
+    if len(pending) >= max_pending:
+      yield pending.popleft().get()
+  while len(pending):
+    yield pending.popleft().get()
+
+__all__ = [ is_jsonl, is_binary, DatasetReader, DatasetWriter, read_records, open_records, batches,
+  imap_bounded ]
@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+
+"""Measure the speed of mention matching and evaluation
+
+Run match_by_trigrams, simple_match, batch processing and the
+evaluation against the bundled QA datasets and synthetic scaled up
+corpora, reporting questions/sec, per pair latency percentiles and
+the peak RSS of every benchmark. Results are saved as json, and may be
+compared against a previous run to spot regressions.
+
+With --startup, the import time of the command line scripts is measured
+too (python -X importtime in a fresh interpreter), along with the heavy
+modules each of them pulls at startup.
+"""
+
+from os.path import abspath, basename, dirname, join, splitext
+from utils import percentile
+
+__author__ = "Guillermo Echegoyen"
+__credits__ = ["Guillermo Echegoyen"]
+__license__ = "GPL v3"
+__version__ = "1.0.0"
+__maintainer__ = "Guillermo Echegoyen"
+__email__ = "gblanco@lsi.uned.es"
+__status__ = "Production"
+
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+
+from glob import glob
+
+CODE_DIR = dirname(abspath(__file__))
+STARTUP_MODULES = ['el_benchmark', 'el_datasets_build', 'el_datasets_merge',
+  'el_datasets_compare', 'el_datasets_prepare', 'el_pipeline']
+# should only be imported when actually used
+HEAVY_MODULES = ['numpy', 'nltk', 'xmltodict', 'multiprocessing', 'sqlite3', 'urllib.request']
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+  '-d',
+  '--dataset',
+  type=str,
+  required=False,
+  action='append',
+  default=None,
+  help='Datasets to benchmark (QA or EL), defaults to the bundled ones.')
+parser.add_argument(
+  '-s',
+  '--scale',
+  type=int,
+  required=False,
+  action='append',
+  default=None,
+  help='Build a synthetic corpus this many times bigger than Complex-EL4QA (repeatable).')
+parser.add_argument(
+  '-b',
+  '--benchmark',
+  type=str,
+  required=False,
+  action='append',
+  default=None,
+  help='Benchmarks to run (trigrams, baseline, batch, evaluate), all by default.')
+parser.add_argument(
+  '-o',
+  '--output',
+  type=str,
+  required=False,
+  default=None,
+  help='Where to save the results (json).')
+parser.add_argument(
+  '-c',
+  '--compare',
+  type=str,
+  required=False,
+  default=None,
+  help='Previous results to compare against.')
+parser.add_argument(
+  '-t',
+  '--threshold',
+  type=float,
+  required=False,
+  default=0.1,
+  help='Relative slowdown (questions/sec) reported as a regression.')
+parser.add_argument(
+  '-r',
+  '--repeat',
+  type=int,
+  required=False,
+  default=3,
+  help='Runs of each benchmark, the fastest one is reported.')
+parser.add_argument(
+  '--warm',
+  required=False,
+  dest='warm',
+  action='store_true',
+  default=False,
+  help='Do not clear the normalization caches before each benchmark.')
+parser.add_argument(
+  '--startup',
+  required=False,
+  dest='startup',
+  action='store_true',
+  default=False,
+  help='Also measure the import time of the scripts.')
+parser.add_argument(
+  '--seed',
+  type=int,
+  required=False,
+  default=1,
+  help='Seed for the synthetic corpora.')
+
+def process_peak_rss_kb():
+  """Peak RSS of this process since it started"""
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # bytes on macos, kilobytes elsewhere
+  return rss // 1024 if sys.platform == 'darwin' else rss
+
+def reset_peak_rss():
+  """Restart the peak RSS of this process from its current RSS, only
+  on linux, False where it can not"""
+  try:
+    with open('/proc/self/clear_refs', 'w') as fp:
+      fp.write('5')
+    return True
+  except OSError:
+    return False
+
+def peak_rss_kb():
+  """Peak RSS since reset_peak_rss (VmHWM)"""
+  with open('/proc/self/status', 'r') as fp:
+    for line in fp:
+      if line.startswith('VmHWM:'):
+        return int(line.split()[1])
+  return None
+
+def load_corpus(path):
+  """EL datapoints of a dataset, QA datasets are built first"""
+  from el_io import read_records
+  questions = list(read_records(path))
+  if not len(questions) or 'dbr' in questions[0]:
+    return questions
+  import el_datasets_build
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    output = join(tmp_dir, basename(path))
+    el_datasets_build.main(el_datasets_build.parser.parse_args(['-d', path, '-o', output]))
+    return list(read_records(output))
+
+def synthetic_corpus(questions, scale, seed=1):
+  """`scale` copies of the datapoints, every copy gets a random extra
+  word so questions are unique and caches do not hide the cost"""
+  rand = random.Random(seed)
+  letters = 'abcdefghijklmnopqrstuvwxyz'
+  corpus = []
+  for copy in range(scale):
+    for question in questions:
+      word = ''.join(rand.choice(letters) for _ in range(rand.randint(3, 9)))
+      tokens = question['question'].split(' ')
+      tokens.insert(rand.randint(0, len(tokens)), word)
+      datapoint = dict(question)
+      datapoint['id'] = len(corpus) +1
+      datapoint['question'] = ' '.join(tokens)
+      corpus.append(datapoint)
+  return corpus
+
+def clear_caches():
+  from utils import clean_str, tokenize_question
+  from el_entities import use_table, table_path
+  clean_str.cache_clear()
+  tokenize_question.cache_clear()
+  # entities are computed (or the table loaded) again
+  use_table(table_path())
+
+def _timed_pairs(match_fn, questions):
+  from utils import clean_str
+  latencies = []
+  for question in questions:
+    start = time.perf_counter()
+    match_fn(clean_str(question['dbr']), clean_str(question['question']))
+    latencies.append(time.perf_counter() - start)
+  return latencies
+
+def bench_trigrams(questions):
+  from el_process import match_by_trigrams
+  return _timed_pairs(match_by_trigrams, questions)
+
+def bench_baseline(questions):
+  from el_process import simple_match
+  return _timed_pairs(simple_match, questions)
+
+def bench_batch(questions):
+  from el_process import process_batch
+  start = time.perf_counter()
+  process_batch(questions, batch_scoring=True)
+  # no per pair latency in a batch, report the mean
+  elapsed = time.perf_counter() - start
+  return [elapsed / max(1, len(questions))] * len(questions)
+
+def setup_evaluate(questions):
+  from el_process import process_batch
+  return process_batch(questions)
+
+def bench_evaluate(processed):
+  from el_evaluate import evaluate_from_dbr
+  latencies = []
+  for question in processed:
+    start = time.perf_counter()
+    evaluate_from_dbr(question)
+    latencies.append(time.perf_counter() - start)
+  return latencies
+
+BENCHMARKS = {
+  'trigrams': bench_trigrams,
+  'baseline': bench_baseline,
+  'batch': bench_batch,
+  'evaluate': bench_evaluate
+}
+# input of a benchmark, built out of its measures
+SETUP = {
+  'evaluate': setup_evaluate
+}
+
+def warm_up(questions):
+  # imports and first calls out of the measures
+  for name in BENCHMARKS:
+    BENCHMARKS[name](SETUP.get(name, list)(questions[:10]))
+  clear_caches()
+
+def run_benchmark(name, corpus_name, questions, warm=False, repeat=1):
+  inputs = SETUP.get(name, list)(questions)
+  best = None
+  peak_rss = None
+  for _ in range(max(1, repeat)):
+    if not warm:
+      clear_caches()
+    per_run_rss = reset_peak_rss()
+    start = time.perf_counter()
+    latencies = BENCHMARKS[name](inputs)
+    elapsed = time.perf_counter() - start
+    if per_run_rss:
+      peak_rss = max(peak_rss or 0, peak_rss_kb())
+    if best is None or elapsed < best[0]:
+      best = (elapsed, sorted(latencies))
+  elapsed, latencies = best
+  return {
+    'benchmark': name,
+    'corpus': corpus_name,
+    'pairs': len(questions),
+    'seconds': elapsed,
+    'questions_per_sec': len(questions) / elapsed if elapsed else 0.0,
+    'p50_ms': percentile(latencies, 50) * 1000,
+    'p95_ms': percentile(latencies, 95) * 1000,
+    'p99_ms': percentile(latencies, 99) * 1000,
+    # peak while the benchmark ran (linux only, None elsewhere)
+    'peak_rss_kb': peak_rss,
+    'process_peak_rss_kb': process_peak_rss_kb()
+  }
+
+def import_time(module, repeat=1):
+  """Fastest import time (ms) of `module` in a fresh interpreter and the
+  heavy modules imported with it (-X importtime needs python 3.7+)"""
+  best = None
+  heavy = set()
+  for _ in range(max(1, repeat)):
+    run = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+      cwd=CODE_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    if run.returncode != 0:
+      raise RuntimeError('Could not import {}: {}'.format(module, run.stderr.strip().split('\n')[-1]))
+    # import time: self [us] | cumulative | imported package
+    for line in run.stderr.split('\n'):
+      if not line.startswith('import time:') or '|' not in line:
+        continue
+      self_us, cumulative_us, name = line[len('import time:'):].split('|')
+      name = name.strip()
+      if name in HEAVY_MODULES:
+        heavy.add(name)
+      elif name == module:
+        elapsed = int(cumulative_us) / 1000
+        best = elapsed if best is None else min(best, elapsed)
+  if best is None:
+    raise RuntimeError('No import time reported for {}'.format(module))
+  return best, sorted(heavy)
+
+def run_startup(module, repeat=1):
+  elapsed, heavy = import_time(module, repeat=repeat)
+  return {
+    'benchmark': 'startup',
+    'corpus': module,
+    'import_ms': elapsed,
+    'heavy_imports': heavy
+  }
+
+def compare(results, previous, threshold):
+  """Print the change against `previous` results, returns regressions:
+  fewer questions/sec or, for startup, more import time"""
+  before = { (r['benchmark'], r['corpus']): r for r in previous['results'] }
+  regressions = []
+  print('{:<10} {:<24} {:>12} {:>12} {:>8}'.format('benchmark', 'corpus', 'before', 'now', 'change'))
+  for result in results:
+    old = before.get((result['benchmark'], result['corpus']))
+    metric = 'import_ms' if result['benchmark'] == 'startup' else 'questions_per_sec'
+    if old is None or not old.get(metric):
+      continue
+    change = result[metric] / old[metric] - 1
+    flag = ''
+    new_heavy = sorted(set(result.get('heavy_imports', [])) - set(old.get('heavy_imports', [])))
+    if (change > threshold) if metric == 'import_ms' else (change < -threshold):
+      flag = ' <- regression'
+    if len(new_heavy):
+      flag = ' <- regression, imports {}'.format(', '.join(new_heavy))
+    if flag:
+      regressions.append(result)
+    print('{:<10} {:<24} {:>12.1f} {:>12.1f} {:>+7.1%}{}'.format(result['benchmark'],
+      result['corpus'], old[metric], result[metric], change, flag))
+  return regressions
+
+def main(FLAGS):
+  datasets = FLAGS.dataset
+  if datasets is None:
+    datasets = sorted(glob(join(CODE_DIR, 'datasets', 'QALD_*.json')))
+    datasets.append(join(CODE_DIR, 'datasets', 'Complex-EL4QA.json'))
+  benchmarks = FLAGS.benchmark or sorted(BENCHMARKS)
+  for name in benchmarks:
+    if name not in BENCHMARKS:
+      parser.error('Unknown benchmark {}'.format(name))
+
+  corpora = []
+  for path in datasets:
+    corpora.append((splitext(basename(path))[0], load_corpus(path)))
+  for scale in (FLAGS.scale or []):
+    base = load_corpus(join(CODE_DIR, 'datasets', 'Complex-EL4QA.json'))
+    corpora.append(('synthetic_x{}'.format(scale), synthetic_corpus(base, scale, seed=FLAGS.seed)))
+
+  warm_up(corpora[0][1])
+  results = []
+  print('{:<10} {:<24} {:>8} {:>10} {:>9} {:>9} {:>9} {:>10}'.format(
+    'benchmark', 'corpus', 'pairs', 'q/s', 'p50 ms', 'p95 ms', 'p99 ms', 'rss KB'))
+  for corpus_name, questions in corpora:
+    for name in benchmarks:
+      result = run_benchmark(name, corpus_name, questions, warm=FLAGS.warm, repeat=FLAGS.repeat)
+      results.append(result)
+      print('{benchmark:<10} {corpus:<24} {pairs:>8} {questions_per_sec:>10.1f} {p50_ms:>9.3f} '
+        '{p95_ms:>9.3f} {p99_ms:>9.3f} {rss:>10}'.format(rss=result['peak_rss_kb'] or '-', **result))
+
+  if FLAGS.startup and sys.version_info < (3, 7):
+    print('Skipping --startup, python -X importtime needs python 3.7+', file=sys.stderr)
+  elif FLAGS.startup:
+    print('{:<10} {:<24} {:>10} {}'.format('benchmark', 'module', 'import ms', 'heavy imports'))
+    for module in STARTUP_MODULES:
+      result = run_startup(module, repeat=FLAGS.repeat)
+      results.append(result)
+      print('{:<10} {:<24} {:>10.1f} {}'.format(result['benchmark'], result['corpus'],
+        result['import_ms'], ', '.join(result['heavy_imports']) or '-'))
+
+  report = {
+    'meta': {
+      'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+      'python': platform.python_version(),
+      'platform': platform.platform()
+    },
+    'results': results
+  }
+  if FLAGS.output is not None:
+    json.dump(fp=open(FLAGS.output, 'w'), obj=report, indent=2)
+
+  if FLAGS.compare is not None:
+    regressions = compare(results, json.load(open(FLAGS.compare, 'r')), FLAGS.threshold)
+    return 1 if len(regressions) else 0
+  return 0
+
+if __name__ == '__main__':
+  FLAGS, unparsed = parser.parse_known_args()
+  sys.exit(main(FLAGS))
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+
+"""Run the whole EL mention Benchmark pipeline
+
+Replacement of pipeline.sh that runs every step in this process, as
+the stages of a DAG: prepare -> build -> entity table -> process and
+evaluate (both methods in a single pass) -> compare -> merge. Every
+stage is keyed by a content hash of its input files, its code (the
+local modules it imports) and its flags, the keys of finished stages
+are kept in a manifest. On a rerun only the stages whose key changed
+are recomputed, downstream stages follow through the hashes of their
+inputs.
+
+Datasets are written atomically and the manifest is saved after each
+stage, so an interrupted run resumes from the stage it was running.
+"""
+
+from os.path import abspath, basename, dirname, exists, isfile, join
+
+__author__ = "Guillermo Echegoyen"
+__credits__ = ["Guillermo Echegoyen"]
+__license__ = "GPL v3"
+__version__ = "1.0.0"
+__maintainer__ = "Guillermo Echegoyen"
+__email__ = "gblanco@lsi.uned.es"
+__status__ = "Production"
+
+import os
+import sys
+import ast
+import json
+import shutil
+import hashlib
+import argparse
+import traceback
+
+from glob import glob
+from functools import lru_cache
+from contextlib import redirect_stdout
+
+CODE_DIR = dirname(abspath(__file__))
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+  '-f',
+  '--force',
+  required=False,
+  dest='force',
+  action='store_true',
+  default=False,
+  help='Recompute every stage, ignoring the manifest.')
+parser.add_argument(
+  '--skip-prepare',
+  required=False,
+  dest='skip_prepare',
+  action='store_true',
+  default=False,
+  help='Do not download/convert the QA datasets, use the ones in datasets/.')
+parser.add_argument(
+  '-w',
+  '--workers',
+  type=int,
+  required=False,
+  default=1,
+  help='Number of processes used by the processing stages.')
+parser.add_argument(
+  '--state-dir',
+  type=str,
+  required=False,
+  default='.pipeline',
+  help='Where to keep the manifest and stage logs.')
+
+def _sha256(path):
+  digest = hashlib.sha256()
+  with open(path, 'rb') as fp:
+    for chunk in iter(lambda: fp.read(1 << 20), b''):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+@lru_cache(maxsize=None)
+def _local_imports(path):
+  tree = ast.parse(open(path, 'r').read(), filename=path)
+  names = set()
+  for node in ast.walk(tree):
+    if isinstance(node, ast.Import):
+      names.update(alias.name.split('.')[0] for alias in node.names)
+    elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+      names.add(node.module.split('.')[0])
+  return sorted(names)
+
+@lru_cache(maxsize=None)
+def code_files(module):
+  """Source of `module` plus every local module it imports"""
+  files = []
+  pending = [module]
+  while len(pending):
+    path = join(CODE_DIR, pending.pop() + '.py')
+    if path in files or not isfile(path):
+      continue
+    files.append(path)
+    pending.extend(_local_imports(path))
+  return tuple(sorted(files))
+
+class Manifest(object):
+  def __init__(self, path):
+    self.path = path
+    self.files = {}
+    self.stages = {}
+    if exists(path):
+      data = json.load(open(path, 'r'))
+      self.files = data.get('files', {})
+      self.stages = data.get('stages', {})
+
+  def file_hash(self, path):
+    # only rehash files whose size or mtime changed
+    stat = os.stat(path)
+    signature = [stat.st_size, stat.st_mtime_ns]
+    cached = self.files.get(path)
+    if cached is not None and cached[:2] == signature:
+      return cached[2]
+    digest = _sha256(path)
+    self.files[path] = signature + [digest]
+    return digest
+
+  def save(self):
+    if not exists(dirname(self.path)):
+      os.makedirs(dirname(self.path))
+    partial = self.path + '.partial'
+    json.dump(fp=open(partial, 'w'), obj={ 'files': self.files, 'stages': self.stages })
+    os.replace(partial, self.path)
+
+class Stage(object):
+  def __init__(self, name, module, run, inputs=None, outputs=None, flags=None, log=None):
+    self.name = name
+    self.module = module
+    self.run = run
+    self.inputs = inputs or []
+    self.outputs = outputs or []
+    self.flags = flags or []
+    self.log = log
+
+  def key(self, manifest):
+    code = code_files(self.module)
+    digest = hashlib.sha256()
+    digest.update(json.dumps([
+      self.name,
+      self.flags,
+      [[path, manifest.file_hash(path)] for path in self.inputs],
+      [[basename(path), manifest.file_hash(path)] for path in code]
+    ]).encode('utf-8'))
+    return digest.hexdigest()
+
+class Pipeline(object):
+  def __init__(self, state_dir, force=False):
+    self.state_dir = state_dir
+    self.logs_dir = join(state_dir, 'logs')
+    self.manifest = Manifest(join(state_dir, 'manifest.json'))
+    self.force = force
+    self.ran = 0
+    self.failed = []
+
+  def log_path(self, stage):
+    return join(self.logs_dir, stage.name.replace('/', '_') + '.txt')
+
+  def is_done(self, stage):
+    """Run `stage` unless it is up to date, True when it succeeded"""
+    if any(not exists(path) for path in stage.inputs):
+      print('-> skip {}, missing inputs'.format(stage.name), file=sys.stderr)
+      self.failed.append(stage.name)
+      return False
+    key = stage.key(self.manifest)
+    record = self.manifest.stages.get(stage.name)
+    if not self.force and record is not None and record['key'] == key and \
+      record['status'] == 'done' and all(exists(path) for path in record['outputs']):
+      return True
+
+    print('-> {}'.format(stage.name))
+    self.ran += 1
+    for path in stage.outputs:
+      # optional outputs (eg: no differences) must not survive from older runs
+      if exists(path):
+        os.remove(path)
+    status = 'done'
+    try:
+      if stage.log is None:
+        stage.run()
+      else:
+        if not exists(self.logs_dir):
+          os.makedirs(self.logs_dir)
+        log = self.log_path(stage)
+        with open(log + '.partial', 'w') as fp, redirect_stdout(fp):
+          stage.run()
+        os.replace(log + '.partial', log)
+    except (Exception, SystemExit):
+      traceback.print_exc()
+      status = 'failed'
+      self.failed.append(stage.name)
+    outputs = [path for path in stage.outputs if exists(path)]
+    for path in outputs:
+      self.manifest.file_hash(path)
+    self.manifest.stages[stage.name] = { 'key': key, 'status': status, 'outputs': outputs }
+    self.manifest.save()
+    return status == 'done'
+
+  def read_log(self, stage):
+    log = self.log_path(stage)
+    return open(log, 'r').read() if exists(log) else ''
+
+def _script(module_name, argv):
+  # run a script main in this process, imported on demand
+  module = __import__(module_name)
+  module.main(module.parser.parse_args(argv))
+
+def main(FLAGS):
+  pipeline = Pipeline(FLAGS.state_dir, force=FLAGS.force)
+  workers = ['-w', str(FLAGS.workers)]
+
+  if not FLAGS.skip_prepare:
+    pipeline.is_done(Stage('prepare', 'el_datasets_prepare',
+      lambda: _script('el_datasets_prepare', [])))
+
+  el_datasets_dir = 'datasets_el'
+  dirs = ['datasets_el', 'datasets_processed', 'datasets_evaluated',
+    'datasets_compared', 'datasets_to_merge']
+  for path in dirs:
+    if not exists(path):
+      os.mkdir(path)
+
+  build_stages = []
+  for dataset in sorted(glob(join('datasets', '*.json'))):
+    el_dataset = join(el_datasets_dir, basename(dataset))
+    stage = Stage('build/' + basename(dataset), 'el_datasets_build',
+      lambda d=dataset, o=el_dataset: _script('el_datasets_build', ['-d', d, '-o', o, '-s']),
+      inputs=[dataset], outputs=[el_dataset], flags=['-s'], log=True)
+    if pipeline.is_done(stage):
+      build_stages.append(stage)
+
+  # labels and trigrams of every dbr, computed once for all the datasets
+  el_datasets = sorted(glob(join(el_datasets_dir, '*.json')))
+  entities = 'entities.json'
+  pipeline.is_done(Stage('entities', 'el_entities',
+    lambda: _script('el_entities', [arg for d in el_datasets for arg in ['-d', d]] + ['-o', entities]),
+    inputs=el_datasets, outputs=[entities]))
+
+  results = []
+  merge_inputs = []
+  for dataset in el_datasets:
+    base_dataset = basename(dataset)
+    process_dataset = 'datasets_processed/{}_process.json'.format(base_dataset)
+    baseline_dataset = 'datasets_processed/{}_baseline.json'.format(base_dataset)
+    evaluate_process_dataset = 'datasets_evaluated/{}_process_evaluated.json'.format(base_dataset)
+    evaluate_baseline_dataset = 'datasets_evaluated/{}_baseline_evaluated.json'.format(base_dataset)
+    compare_dataset = 'datasets_compared/{}.json'.format(base_dataset)
+    merge_dataset = 'datasets_to_merge/{}_process_evaluated.json'.format(base_dataset)
+
+    # both methods processed and evaluated in a single pass
+    fused = Stage('process_evaluate/' + base_dataset, 'el_benchmark',
+      lambda d=dataset, b=base_dataset: _script('el_benchmark', ['-d', d, '--fused', '-k',
+        '-o', join('datasets_processed', b), '--evaluated-output', join('datasets_evaluated', b),
+        '--entities', entities] + workers),
+      inputs=[dataset, entities], outputs=[process_dataset, baseline_dataset, evaluate_process_dataset,
+        evaluate_baseline_dataset], flags=['--fused', '-k'], log=True)
+    pipeline.is_done(fused)
+    # log lines are prefixed by the method
+    logs = { 'process': [], 'baseline': [] }
+    for line in pipeline.read_log(fused).split('\n'):
+      method, _, text = line.partition(': ')
+      if method in logs:
+        logs[method].append(text)
+        if text.startswith('Acc '):
+          # results of pipeline.sh show the accuracy twice
+          logs[method].append(text)
+
+    results.append('======= {} ======='.format(dataset))
+    results.append('-> {}'.format(process_dataset))
+    results.append('\n'.join(logs['process']))
+    results.append('-> {}'.format(baseline_dataset))
+    results.append('\n'.join(logs['baseline']))
+    results.append('==============================')
+
+    pipeline.is_done(Stage('compare/' + base_dataset, 'el_datasets_compare',
+      lambda p=process_dataset, b=baseline_dataset, o=compare_dataset: _script(
+        'el_datasets_compare', ['-d', p, '-d', b, '-o', o]),
+      inputs=[process_dataset, baseline_dataset], outputs=[compare_dataset]))
+    if pipeline.is_done(Stage('collect/' + base_dataset, 'el_pipeline',
+        lambda s=evaluate_process_dataset, o=merge_dataset: shutil.copyfile(s, o),
+        inputs=[evaluate_process_dataset], outputs=[merge_dataset])):
+      merge_inputs.append(merge_dataset)
+
+  # the merge reads the whole directory, drop leftovers of older runs
+  for path in glob(join('datasets_to_merge', '*')):
+    if path not in merge_inputs:
+      os.remove(path)
+  pipeline.is_done(Stage('merge', 'el_datasets_merge',
+    lambda: _script('el_datasets_merge', ['--dir', 'datasets_to_merge', '-o', 'Complex-EL4QA.json']),
+    inputs=sorted(merge_inputs), outputs=['Complex-EL4QA.json']))
+
+  with open('stats', 'w') as fp:
+    fp.write(''.join(pipeline.read_log(stage) for stage in build_stages))
+  with open('results', 'w') as fp:
+    fp.write('\n'.join(results) + '\n')
+
+  print('{} stages run, {} failed'.format(pipeline.ran, len(pipeline.failed)), file=sys.stderr)
+  for name in pipeline.failed:
+    print('   failed: {}'.format(name), file=sys.stderr)
+  return 1 if len(pipeline.failed) else 0
+
+if __name__ == '__main__':
+  FLAGS, unparsed = parser.parse_known_args()
+  sys.exit(main(FLAGS))
@@ -2,8 +2,9 @@
 Benchmark, includes both the custom, trigram based and baseline
 methods from the paper."""
 
-from nltk.metrics import edit_distance
-from utils import clean_str, ngrams, str_to_trigrams_dict, overlap_trigrams_score, MinStore, MentionSet
+from el_distance import edit_distance, max_distance
+from el_entities import get_entity
+from utils import clean_str, ngrams, tokenize_question, str_to_trigrams_dict, overlap_trigrams_score, overlap_trigrams_set_score, span_str_len, MinStore, TopKStore, MentionSet
 
 __author__ = "Guillermo Echegoyen"
 __credits__ = ["Guillermo Echegoyen"]
@@ -13,79 +14,150 @@ __maintainer__ = "Guillermo Echegoyen"
 __email__ = "gblanco@lsi.uned.es"
 __status__ = "Production"
 
+# el_batch.score_pairs, False without numpy (see get_score_pairs)
+_score_pairs = None
+
 def get_mentions(dbr, question):
   tris = str_to_trigrams_dict(dbr.lower())
+  words = question.split(' ')
+  probs = [overlap_trigrams_score(tris, ngrams(word.lower())) for word in words]
+  return get_mentions_from_scores(words, probs)
+
+def get_mentions_from_scores(words, probs):
   sets = []
-  best_guess = MinStore()
-  current_mention = MentionSet()
-  for index, word in enumerate(question.split(' ')):
-    word_trigrams = ngrams(word.lower())
-    prob = overlap_trigrams_score(tris, word_trigrams)
-    if not current_mention.append(word, index, prob):
-      mention = MentionSet(mention=[word], indexes=[index], prob=prob)
-      best_guess.store(mention, prob)
+  # best single word guess, kept as its index until it is needed
+  best_guess = MinStore(key=lambda index: span_str_len(words, index, index +1))
+  current_mention = MentionSet(words)
+  for index, prob in enumerate(probs):
+    if not current_mention.append(index, prob):
+      best_guess.store(index, prob)
       if not current_mention.is_empty():
         sets.append(current_mention)
-      current_mention = MentionSet()
-  
+        current_mention = MentionSet(words)
+
   if not current_mention.is_empty():
     sets.append(current_mention)
 
   if len(sets) == 0:
     # no match found, best guess time
     best_guess = best_guess.get_item()
+    if best_guess is not None:
+      best_guess = MentionSet(words, best_guess, best_guess +1, probs[best_guess])
     sets = [best_guess]
 
   return sets
 
-def dist(mention, dbr):
-  ment = ' '.join(mention) if type(mention) is list else mention
-  ment_len = len(''.join(mention))
-  return edit_distance(ment, dbr) / ment_len
+def dist(mention, dbr, bound=None):
+  """Edit distance normalized by the mention length. Given a `bound`
+  (the best distance so far) returns None as soon as the distance is
+  known to be greater than it"""
+  if type(mention) is list:
+    ment = ' '.join(mention)
+    ment_len = len(''.join(mention))
+  else:
+    ment = mention
+    ment_len = len(mention)
+  if bound is None or ment_len == 0:
+    return edit_distance(ment, dbr) / ment_len
+  max_dist = max_distance(bound, ment_len)
+  distance = edit_distance(ment, dbr, max_dist=max_dist)
+  if distance > max_dist:
+    return None
+  return distance / ment_len
+
+def _new_store(k, key):
+  # the single best, or the k best spans
+  if k is None:
+    return MinStore(cmp='min_metric', key=key)
+  return TopKStore(k, key=key)
+
+def _span_prob(probs, start, end):
+  # mean trigram overlap of the tokens of a span
+  return float(sum(probs[start:end])) / (end - start) if end > start else 0.0
 
-def match_by_trigrams(raw_dbr, raw_question):
+def _trigram_spans(raw_dbr, raw_question, probs=None, k=None, trigrams=None):
   dbr = raw_dbr.lower()
-  question = raw_question.lower()
-  mentions = get_mentions(dbr, question)
-  best_mention = MinStore(cmp='min_metric')
+  # same as get_mentions(dbr, raw_question.lower()), question work is cached
+  question_parts, words, words_trigrams = tokenize_question(raw_question)
+  if probs is None and trigrams is not None:
+    # dbr trigrams from the entity table
+    probs = [overlap_trigrams_set_score(trigrams, word_trigrams) for word_trigrams in words_trigrams]
+  elif probs is None:
+    tris = str_to_trigrams_dict(dbr.lower())
+    probs = [overlap_trigrams_score(tris, word_trigrams) for word_trigrams in words_trigrams]
+  # else, scores already computed in batch (see el_batch)
+  mentions = get_mentions_from_scores(words, probs)
+  best_mentions = _new_store(k, MentionSet.str_len)
   for mention in mentions:
-    m = MentionSet(mention=mention.get_mention(), indexes=mention.get_indexes(), prob=mention.prob)
     mention.reduce(dbr)
-    mention_distance = dist(' '.join(mention.get_mention()), dbr)
-    best_mention.store(mention, mention_distance)
+    mention_distance = dist(' '.join(mention.get_mention()), dbr, bound=best_mentions.metric)
+    if mention_distance is not None:
+      best_mentions.store(mention, mention_distance)
+  return best_mentions, question_parts, probs
 
+def match_by_trigrams(raw_dbr, raw_question, probs=None, trigrams=None):
+  best_mention, question_parts, _ = _trigram_spans(raw_dbr, raw_question, probs=probs,
+    trigrams=trigrams)
   best_mention = best_mention.get_item()
   if best_mention is not None:
-    question_parts = raw_question.split(' ')
-    best_mention = ' '.join([question_parts[idx] for idx in best_mention.get_indexes()])
+    best_mention = ' '.join(question_parts[best_mention.start:best_mention.end])
 
   return best_mention
 
-def simple_match(raw_dbr, raw_question):
+def match_by_trigrams_top_k(raw_dbr, raw_question, k, probs=None, trigrams=None):
+  """The `k` best mentions of match_by_trigrams, best first, as dicts
+  with the `mention`, its mean trigram `prob` and normalized edit
+  `distance`. The first one is always what match_by_trigrams returns"""
+  best_mentions, question_parts, probs = _trigram_spans(raw_dbr, raw_question, probs=probs, k=k,
+    trigrams=trigrams)
+  return [{
+    'mention': ' '.join(question_parts[mention.start:mention.end]),
+    'prob': _span_prob(probs, mention.start, mention.end),
+    'distance': distance
+  } for mention, distance in best_mentions.get_items()]
+
+def _simple_spans(raw_dbr, raw_question, k=None):
   dbr = raw_dbr.lower()
-  question = raw_question.lower()
-  question_parts = question.split(' ')
+  raw_question_parts, question_parts, words_trigrams = tokenize_question(raw_question)
   # all the spans of size equal to the number of tokens in dbr
   n_tokens = len(dbr.split(' '))
-  parts = [(question_parts[i:i+n_tokens], i, i+n_tokens)
-            for i in range(0, len(question_parts)-(n_tokens-1))]
-  # get the span that minimizes edit distance
-  best_mention = MinStore(cmp='min_metric')
-  # print('simple_match parts', parts)
-  for part, word_start, word_end in parts:
-    indexes = list(range(word_start, word_end))
-    part_mention = ' '.join(part)
-    distance = dist(part_mention, dbr)
-    mention = MentionSet(mention=part, indexes=indexes, prob=distance)
-    best_mention.store(mention, distance)
+  # get the span that minimizes edit distance, kept as its start index
+  best_mentions = _new_store(k, lambda start: span_str_len(question_parts, start, start + n_tokens))
+  for start in range(0, len(question_parts)-(n_tokens-1)):
+    part_mention = ' '.join(question_parts[start:start + n_tokens])
+    distance = dist(part_mention, dbr, bound=best_mentions.metric)
+    if distance is None:
+      # can not beat the best mention
+      continue
+    best_mentions.store(start, distance)
+  return best_mentions, raw_question_parts, words_trigrams, n_tokens
 
+def simple_match(raw_dbr, raw_question):
+  best_mention, raw_question_parts, _, n_tokens = _simple_spans(raw_dbr, raw_question)
   best_mention = best_mention.get_item()
   if best_mention is not None:
-    question_parts = raw_question.split(' ')
-    best_mention = ' '.join([question_parts[idx] for idx in best_mention.get_indexes()])
+    best_mention = ' '.join(raw_question_parts[best_mention:best_mention + n_tokens])
 
   return best_mention
 
+def simple_match_top_k(raw_dbr, raw_question, k):
+  """The `k` best mentions of simple_match, best first, same dicts as
+  match_by_trigrams_top_k"""
+  best_mentions, raw_question_parts, words_trigrams, n_tokens = _simple_spans(raw_dbr,
+    raw_question, k=k)
+  candidates = best_mentions.get_items()
+  tris = str_to_trigrams_dict(raw_dbr.lower()) if len(candidates) else None
+  outputs = []
+  for start, distance in candidates:
+    probs = [overlap_trigrams_score(tris, word_trigrams)
+      for word_trigrams in words_trigrams[start:start + n_tokens]]
+    outputs.append({
+      'mention': ' '.join(raw_question_parts[start:start + n_tokens]),
+      'prob': _span_prob(probs, 0, len(probs)),
+      'distance': distance
+    })
+  return outputs
+
 def merge(raw_dbr, mention_1, mention_2):
   dbr = raw_dbr.lower()
   if mention_1 is None or type(mention_1) is not str:
@@ -93,22 +165,76 @@ def merge(raw_dbr, mention_1, mention_2):
   if mention_2 is None or type(mention_2) is not str:
     return mention_1
   ed_1 = edit_distance(mention_1.lower(), dbr)
-  ed_2 = edit_distance(mention_2.lower(), dbr)
+  # only need to know whether it is greater than ed_1
+  ed_2 = edit_distance(mention_2.lower(), dbr, max_dist=ed_1)
   ret = mention_2
   if ed_1 < ed_2:
     ret = mention_1
   return ret
 
-def process(eval_tuple, baseline=False):
-  dbr = clean_str(eval_tuple['dbr'])
-  question = clean_str(eval_tuple['question'])
-  match_fn = simple_match if baseline else match_by_trigrams
-  mention = match_fn(dbr, question)
-  # mention = merge(dbr, match_by_trigrams(dbr, question), simple_match(dbr, question))
+def _output(eval_tuple, mention, candidates=None):
   if mention is None:
     mention = ''
   output = eval_tuple.copy()
   output['mention'] = mention
+  if candidates is not None:
+    output['candidates'] = candidates
   return output
 
-__all__ = [ process ]
+def _output_top_k(eval_tuple, candidates):
+  # the best candidate is the mention
+  return _output(eval_tuple, candidates[0]['mention'] if len(candidates) else None, candidates)
+
+def process(eval_tuple, baseline=False, top_k=None):
+  """Datapoint plus its `mention`, with top_k also the `candidates`
+  (see match_by_trigrams_top_k)"""
+  entity = get_entity(eval_tuple['dbr'])
+  dbr = entity.label
+  question = clean_str(eval_tuple['question'])
+  if top_k is not None:
+    if baseline:
+      return _output_top_k(eval_tuple, simple_match_top_k(dbr, question, top_k))
+    return _output_top_k(eval_tuple, match_by_trigrams_top_k(dbr, question, top_k,
+      trigrams=entity.trigrams))
+  if baseline:
+    mention = simple_match(dbr, question)
+  else:
+    mention = match_by_trigrams(dbr, question, trigrams=entity.trigrams)
+  # mention = merge(dbr, match_by_trigrams(dbr, question), simple_match(dbr, question))
+  return _output(eval_tuple, mention)
+
+def get_score_pairs():
+  """el_batch.score_pairs or None without numpy, imported on first use
+  as numpy alone takes longer to import than everything else"""
+  global _score_pairs
+  if _score_pairs is None:
+    try:
+      from el_batch import score_pairs
+    except ImportError:
+      # numpy not available, fallback to per pair scoring
+      score_pairs = False
+    _score_pairs = score_pairs
+  return _score_pairs or None
+
+def process_batch(eval_tuples, baseline=False, top_k=None, batch_scoring=False):
+  """Same as calling process on every tuple. With `batch_scoring`,
+  trigram scores for the whole batch are computed at once (el_batch),
+  off by default: interning every question trigram again for each batch
+  costs about as much as it saves over per pair scoring"""
+  score_pairs = None if baseline or not batch_scoring else get_score_pairs()
+  if score_pairs is None:
+    return [process(eval_tuple, baseline=baseline, top_k=top_k) for eval_tuple in eval_tuples]
+  dbrs = [get_entity(eval_tuple['dbr']).label for eval_tuple in eval_tuples]
+  questions = [clean_str(eval_tuple['question']) for eval_tuple in eval_tuples]
+  scores = score_pairs([dbr.lower() for dbr in dbrs], questions)
+  outputs = []
+  for eval_tuple, dbr, question, probs in zip(eval_tuples, dbrs, questions, scores):
+    if top_k is not None:
+      outputs.append(_output_top_k(eval_tuple, match_by_trigrams_top_k(dbr, question, top_k,
+        probs=probs)))
+      continue
+    mention = match_by_trigrams(dbr, question, probs=probs)
+    outputs.append(_output(eval_tuple, mention))
+  return outputs
+
+__all__ = [ process, process_batch ]
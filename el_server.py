@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+
+"""Mention linking service for EL mention Benchmark
+
+Long running asyncio HTTP server (tcp or unix socket), so normalization
+and trigram caches stay warm between requests. Endpoints:
+ - POST /process: `{"questions": [{"question": ..., "dbr": ...}, ...],
+   "baseline": false}`, answers `{"questions": [...]}`, every datapoint
+   as returned by el_process.process (the input plus its mention)
+ - GET /metrics: request counts and latency percentiles of the last
+   requests, plus cache stats
+ - GET /health
+
+`Client` talks to a running server, eg: for tests.
+"""
+
+from el_process import process_batch
+from utils import clean_str_stats, tokenize_question, percentile
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+
+__author__ = "Guillermo Echegoyen"
+__credits__ = ["Guillermo Echegoyen"]
+__license__ = "GPL v3"
+__version__ = "1.0.0"
+__maintainer__ = "Guillermo Echegoyen"
+__email__ = "gblanco@lsi.uned.es"
+__status__ = "Production"
+
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import http.client
+
+DEFAULT_PORT = 8642
+METRICS_WINDOW = 10000
+MAX_BODY_SIZE = 64 << 20
+STATUS = { 200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+  413: 'Payload Too Large', 500: 'Internal Server Error' }
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+  '--host',
+  type=str,
+  required=False,
+  default='127.0.0.1',
+  help='Address to listen on.')
+parser.add_argument(
+  '-p',
+  '--port',
+  type=int,
+  required=False,
+  default=DEFAULT_PORT,
+  help='Port to listen on.')
+parser.add_argument(
+  '-u',
+  '--unix',
+  type=str,
+  required=False,
+  default=None,
+  help='Listen on this unix socket instead of tcp.')
+
+class RequestError(Exception):
+  def __init__(self, status, message):
+    super(RequestError, self).__init__(message)
+    self.status = status
+
+class LatencyStats(object):
+  """Counters plus the latency of the last `window` requests"""
+  def __init__(self, window=METRICS_WINDOW):
+    self.latencies = deque(maxlen=window)
+    self.requests = 0
+    self.errors = 0
+    self.pairs = 0
+    self.started = time.time()
+
+  def add(self, seconds, pairs):
+    self.latencies.append(seconds)
+    self.requests += 1
+    self.pairs += pairs
+
+  def to_dict(self):
+    latencies = sorted(self.latencies)
+    return {
+      'uptime_sec': time.time() - self.started,
+      'requests': self.requests,
+      'errors': self.errors,
+      'pairs': self.pairs,
+      'latency_ms': {
+        'window': len(latencies),
+        'p50': percentile(latencies, 50) * 1000,
+        'p95': percentile(latencies, 95) * 1000,
+        'p99': percentile(latencies, 99) * 1000,
+        'max': latencies[-1] * 1000 if len(latencies) else 0.0
+      }
+    }
+
+def parse_questions(body):
+  try:
+    data = json.loads(body.decode('utf-8'))
+  except ValueError as e:
+    raise RequestError(400, 'Bad json: {}'.format(e))
+  if not isinstance(data, dict) or not isinstance(data.get('questions'), list):
+    raise RequestError(400, 'Expected {"questions": [...]}')
+  for question in data['questions']:
+    if not isinstance(question, dict) or not isinstance(question.get('question'), str) or \
+      not isinstance(question.get('dbr'), str):
+      raise RequestError(400, 'Every question needs "question" and "dbr" strings')
+  return data['questions'], bool(data.get('baseline', False))
+
+class MentionServer(object):
+  def __init__(self):
+    self.stats = LatencyStats()
+    # one thread: the loop keeps serving while a batch is processed,
+    # batches run one at a time over the same caches
+    self.executor = ThreadPoolExecutor(max_workers=1)
+
+  async def read_request(self, reader):
+    line = await reader.readline()
+    if not line.strip():
+      return None
+    try:
+      method, target, version = line.decode('latin-1').rstrip('\r\n').split(' ', 2)
+    except ValueError:
+      raise RequestError(400, 'Bad request line')
+    headers = {}
+    while True:
+      line = await reader.readline()
+      if line in (b'\r\n', b'\n', b''):
+        break
+      name, _, value = line.decode('latin-1').partition(':')
+      headers[name.strip().lower()] = value.strip()
+    try:
+      length = int(headers.get('content-length', 0) or 0)
+    except ValueError:
+      raise RequestError(400, 'Bad Content-Length')
+    if length < 0:
+      raise RequestError(400, 'Bad Content-Length')
+    if length > MAX_BODY_SIZE:
+      raise RequestError(413, 'Body over {} bytes'.format(MAX_BODY_SIZE))
+    body = await reader.readexactly(length) if length else b''
+    return method, target.split('?')[0], version, headers, body
+
+  async def dispatch(self, method, path, body):
+    if path == '/process':
+      if method != 'POST':
+        raise RequestError(405, 'Use POST')
+      questions, baseline = parse_questions(body)
+      start = time.perf_counter()
+      loop = asyncio.get_event_loop()
+      outputs = await loop.run_in_executor(self.executor, process_batch, questions, baseline)
+      self.stats.add(time.perf_counter() - start, len(questions))
+      return { 'questions': outputs }
+    if path == '/metrics':
+      metrics = self.stats.to_dict()
+      metrics['clean_str_cache'] = clean_str_stats()
+      metrics['question_cache'] = tokenize_question.cache_info()._asdict()
+      return metrics
+    if path == '/health':
+      return { 'status': 'ok' }
+    raise RequestError(404, 'No such endpoint {}'.format(path))
+
+  async def handle(self, reader, writer):
+    try:
+      while True:
+        keep_alive = False
+        try:
+          request = await self.read_request(reader)
+          if request is None:
+            break
+          method, path, version, headers, body = request
+          keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+          status, obj = 200, await self.dispatch(method, path, body)
+        except RequestError as e:
+          self.stats.errors += 1
+          status, obj = e.status, { 'error': str(e) }
+        except (asyncio.IncompleteReadError, ConnectionError):
+          break
+        except Exception as e:
+          self.stats.errors += 1
+          status, obj = 500, { 'error': '{}: {}'.format(type(e).__name__, e) }
+        payload = json.dumps(obj, ensure_ascii=False).encode('utf-8')
+        writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\n'
+          'Content-Length: {}\r\nConnection: {}\r\n\r\n'.format(status, STATUS[status],
+          len(payload), 'keep-alive' if keep_alive else 'close').encode('latin-1') + payload)
+        await writer.drain()
+        if not keep_alive:
+          break
+    finally:
+      writer.close()
+
+  async def serve(self, host='127.0.0.1', port=DEFAULT_PORT, unix=None, ready=None):
+    if unix is not None:
+      server = await asyncio.start_unix_server(self.handle, path=unix)
+    else:
+      server = await asyncio.start_server(self.handle, host=host, port=port)
+    if ready is not None:
+      ready(server)
+    try:
+      # until cancelled (Server.serve_forever is python 3.7+)
+      await asyncio.get_event_loop().create_future()
+    finally:
+      server.close()
+      await server.wait_closed()
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+  def __init__(self, path, timeout=None):
+    super(_UnixHTTPConnection, self).__init__('localhost', timeout=timeout)
+    self.path = path
+
+  def connect(self):
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.sock.settimeout(self.timeout)
+    self.sock.connect(self.path)
+
+class Client(object):
+  """Blocking client of a running MentionServer, keeps its connection"""
+  def __init__(self, host='127.0.0.1', port=DEFAULT_PORT, unix=None, timeout=60):
+    if unix is not None:
+      self.connection = _UnixHTTPConnection(unix, timeout=timeout)
+    else:
+      self.connection = http.client.HTTPConnection(host, port, timeout=timeout)
+
+  def request(self, method, path, obj=None):
+    body = None if obj is None else json.dumps(obj, ensure_ascii=False).encode('utf-8')
+    headers = { 'Content-Type': 'application/json' } if body is not None else {}
+    self.connection.request(method, path, body=body, headers=headers)
+    response = self.connection.getresponse()
+    data = json.loads(response.read().decode('utf-8'))
+    if response.status != 200:
+      raise RuntimeError('{} {}: {}'.format(response.status, response.reason, data.get('error')))
+    return data
+
+  def process(self, questions, baseline=False):
+    return self.request('POST', '/process', { 'questions': questions, 'baseline': baseline })['questions']
+
+  def metrics(self):
+    return self.request('GET', '/metrics')
+
+  def close(self):
+    self.connection.close()
+
+def main(FLAGS):
+  def ready(server):
+    where = FLAGS.unix if FLAGS.unix is not None else '{}:{}'.format(FLAGS.host, FLAGS.port)
+    print('Listening on {}'.format(where), file=sys.stderr)
+  # asyncio.run is python 3.7+
+  loop = asyncio.get_event_loop()
+  serving = asyncio.ensure_future(MentionServer().serve(host=FLAGS.host, port=FLAGS.port,
+    unix=FLAGS.unix, ready=ready))
+  try:
+    loop.run_until_complete(serving)
+  except KeyboardInterrupt:
+    # let serve close the server
+    serving.cancel()
+    try:
+      loop.run_until_complete(serving)
+    except asyncio.CancelledError:
+      pass
+  finally:
+    loop.close()
+
+if __name__ == '__main__':
+  FLAGS, unparsed = parser.parse_known_args()
+  main(FLAGS)
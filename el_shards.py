@@ -0,0 +1,316 @@
+"""Sharded processing for EL mention Benchmark
+
+A dataset is split once into N shards by a hash of the datapoint id,
+so the split is the same on every node. Shards live in a directory
+every worker can see (eg: a shared filesystem): any number of workers,
+on any node, claim shards by creating their lock file (O_EXCL, only one
+worker gets each), process them and mark them done along with their
+counts. The worker that completes the last shard merges the outputs,
+in the original order (every shard output keeps the original position
+of its records), and sums the counts, so the result is the same as a
+single run.
+
+While a worker holds a lock (to split, process a shard or merge) a
+thread keeps touching it. A lock untouched for longer than the lock
+timeout belongs to a dead worker, and is taken over. Two workers may
+then hold the same lock, if its owner was only stalled, so files are
+written under names of their own (host.pid) and moved into place: both
+write the same content, whoever moves it last.
+
+Layout of the directory:
+  split.json                 the dataset (its size and mtime), number of
+                             shards and header
+  shard_<i>.json             datapoints of shard i
+  shard_<i>_<name>.json      output `name` of shard i
+  *.positions                original position of every record of a file
+  shard_<i>.lock / .done     claimed / finished (with its counts)
+  split.lock, merge.lock     splitting / merging
+  merged.json                outputs of the last merge
+"""
+
+from el_io import read_records, DatasetWriter
+from os.path import abspath, exists, join, getmtime
+
+__author__ = "Guillermo Echegoyen"
+__credits__ = ["Guillermo Echegoyen"]
+__license__ = "GPL v3"
+__version__ = "1.0.0"
+__maintainer__ = "Guillermo Echegoyen"
+__email__ = "gblanco@lsi.uned.es"
+__status__ = "Production"
+
+import os
+import json
+import time
+import heapq
+import socket
+import hashlib
+import threading
+
+POLL_SECONDS = 0.2
+# claimed and not touched for this long, the owner is dead
+DEFAULT_LOCK_TIMEOUT = 600
+
+def shard_of(datapoint_id, n_shards):
+  """Shard of a datapoint, the same in every process and node"""
+  digest = hashlib.md5(str(datapoint_id).encode('utf-8')).digest()
+  return int.from_bytes(digest[:8], 'big') % n_shards
+
+def owner_tag():
+  """This process, among the workers of every node"""
+  return '{}.{}'.format(socket.gethostname(), os.getpid())
+
+def _dump_atomic(path, obj):
+  partial = join(os.path.dirname(path), '.{}.{}.partial'.format(os.path.basename(path),
+    owner_tag()))
+  with open(partial, 'w') as fp:
+    json.dump(fp=fp, obj=obj)
+  os.replace(partial, path)
+
+def positions_path(path):
+  return path + '.positions'
+
+class PositionalWriter(object):
+  """DatasetWriter that also saves the original position of every record"""
+  def __init__(self, path, header=None):
+    self.path = path
+    self.writer = DatasetWriter(path, header=header, owner=owner_tag())
+    self.positions = []
+
+  def write(self, record, position):
+    self.writer.write(record)
+    self.positions.append(position)
+
+  def close(self):
+    # positions first: a dataset is only there with its positions
+    _dump_atomic(positions_path(self.path), self.positions)
+    self.writer.close()
+
+  def abort(self):
+    self.writer.abort()
+
+def read_positional(path):
+  """(position, record) of a PositionalWriter output"""
+  return zip(json.load(open(positions_path(path), 'r')), read_records(path))
+
+def merge_positional(paths, output, header=None):
+  """Merge PositionalWriter outputs into `output`, in position order"""
+  with DatasetWriter(output, header=header, owner=owner_tag()) as writer:
+    for position, record in heapq.merge(*[read_positional(path) for path in paths],
+      key=lambda item: item[0]):
+      writer.write(record)
+  return writer.count
+
+class Heartbeat(object):
+  """Touches a lock every `interval` seconds from a thread while its
+  owner works, `lost` once the lock is no longer its own (taken over)"""
+  def __init__(self, lock, owner, interval):
+    self.lock = lock
+    self.owner = owner
+    self.interval = interval
+    self.lost = False
+    self.stopped = threading.Event()
+    self.thread = threading.Thread(target=self._run, daemon=True)
+
+  def touch(self):
+    try:
+      with open(self.lock, 'r') as fp:
+        if fp.read() != self.owner:
+          return False
+      os.utime(self.lock)
+      return True
+    except FileNotFoundError:
+      return False
+
+  def _run(self):
+    while not self.stopped.wait(self.interval):
+      if not self.touch():
+        self.lost = True
+        return
+
+  def __enter__(self):
+    self.thread.start()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.stopped.set()
+    self.thread.join()
+    # taken over since the last touch
+    if not self.lost and not self.touch():
+      self.lost = True
+
+class ShardQueue(object):
+  def __init__(self, directory, n_shards, lock_timeout=DEFAULT_LOCK_TIMEOUT):
+    self.directory = directory
+    self.n_shards = n_shards
+    # locks not touched for this many seconds may be taken over
+    self.lock_timeout = lock_timeout
+    # lock -> owner of the locks held by this process
+    self.owners = {}
+    if not exists(directory):
+      os.makedirs(directory, exist_ok=True)
+
+  def path(self, name):
+    return join(self.directory, name)
+
+  def shard_path(self, shard, name=None):
+    if name is None:
+      return self.path('shard_{}.json'.format(shard))
+    return self.path('shard_{}_{}.json'.format(shard, name))
+
+  def shard_lock(self, shard):
+    return self.path('shard_{}.lock'.format(shard))
+
+  def _create(self, path, content=''):
+    # atomic on posix filesystems (and NFSv3+), only one process gets it
+    try:
+      fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+      return False
+    with os.fdopen(fd, 'w') as fp:
+      fp.write(content)
+    return True
+
+  def _owner(self):
+    return json.dumps({ 'host': socket.gethostname(), 'pid': os.getpid(), 'time': time.time() })
+
+  def _now(self):
+    # clock of the filesystem the locks are touched on, nodes may disagree
+    clock = self.path('.clock.{}'.format(owner_tag()))
+    try:
+      with open(clock, 'a'):
+        os.utime(clock)
+      return getmtime(clock)
+    finally:
+      os.remove(clock)
+
+  def _is_stale(self, lock):
+    if self.lock_timeout is None:
+      return False
+    try:
+      return self._now() - getmtime(lock) > self.lock_timeout
+    except FileNotFoundError:
+      return False
+
+  def _take(self, lock):
+    """Create `lock`, taking it over when stale, True if this process
+    holds it now"""
+    if self._is_stale(lock):
+      try:
+        # only one process renames it away
+        os.rename(lock, '{}.stale.{}'.format(lock, owner_tag()))
+      except FileNotFoundError:
+        pass
+    owner = self._owner()
+    if self._create(lock, owner):
+      self.owners[lock] = owner
+      return True
+    return False
+
+  def hold(self, lock):
+    """Heartbeat of a lock this process took, while in the context"""
+    interval = POLL_SECONDS
+    if self.lock_timeout is not None:
+      interval = max(POLL_SECONDS, self.lock_timeout / 4)
+    return Heartbeat(lock, self.owners[lock], interval)
+
+  def _release(self, lock):
+    # unless some other process took it over
+    if Heartbeat(lock, self.owners.pop(lock), 0).touch():
+      os.remove(lock)
+
+  def split(self, dataset, records, header):
+    """Split `records` into the shards, unless some worker already did
+    (or is doing it, then wait for it). Returns the split metadata"""
+    split_path = self.path('split.json')
+    lock = self.path('split.lock')
+    # a dataset edited in place is not the one split
+    stat = os.stat(dataset)
+    version = { 'size': stat.st_size, 'mtime': stat.st_mtime }
+    while not exists(split_path):
+      if self._take(lock):
+        with self.hold(lock):
+          self._split(split_path, dataset, version, records, header)
+        break
+      time.sleep(POLL_SECONDS)
+    split = json.load(open(split_path, 'r'))
+    if split['dataset'] != abspath(dataset) or split['shards'] != self.n_shards:
+      raise ValueError('{} holds {} in {} shards, not {} in {}'.format(self.directory,
+        split['dataset'], split['shards'], abspath(dataset), self.n_shards))
+    if split.get('version') != version:
+      raise ValueError('{} changed since it was split into {}, remove it to split it '
+        'again'.format(abspath(dataset), self.directory))
+    return split
+
+  def _split(self, split_path, dataset, version, records, header):
+    writers = [PositionalWriter(self.shard_path(shard), header=header)
+      for shard in range(self.n_shards)]
+    count = 0
+    for position, record in enumerate(records):
+      writers[shard_of(record['id'], self.n_shards)].write(record, position)
+      count += 1
+    for writer in writers:
+      writer.close()
+    _dump_atomic(split_path, { 'dataset': abspath(dataset), 'version': version,
+      'shards': self.n_shards, 'count': count, 'header': header })
+
+  def claim(self):
+    """A shard nobody claimed (or whose lock went stale), None if none"""
+    for shard in range(self.n_shards):
+      if self.is_done(shard):
+        continue
+      if self._take(self.shard_lock(shard)):
+        if self.is_done(shard):
+          # completed (and released) since checked
+          self._release(self.shard_lock(shard))
+          continue
+        return shard
+    return None
+
+  def complete(self, shard, counts):
+    _dump_atomic(self.path('shard_{}.done'.format(shard)), counts)
+    self._release(self.shard_lock(shard))
+
+  def is_done(self, shard):
+    return exists(self.path('shard_{}.done'.format(shard)))
+
+  def all_done(self):
+    return all(self.is_done(shard) for shard in range(self.n_shards))
+
+  def counts(self):
+    """Sum of the counts of every shard (dicts of [hits, total])"""
+    total = {}
+    for shard in range(self.n_shards):
+      counts = json.load(open(self.path('shard_{}.done'.format(shard)), 'r'))
+      for name, values in counts.items():
+        current = total.setdefault(name, [0] * len(values))
+        for index, value in enumerate(values):
+          current[index] += value
+    return total
+
+  def is_merged(self, outputs):
+    """Whether `outputs` were merged and are still there"""
+    merged_path = self.path('merged.json')
+    if not exists(merged_path):
+      return False
+    merged = json.load(open(merged_path, 'r'))
+    return merged['outputs'] == [abspath(output) for output in outputs] and \
+      all(exists(output) for output in outputs)
+
+  def claim_merge(self):
+    return self._take(self.path('merge.lock'))
+
+  def hold_merge(self):
+    return self.hold(self.path('merge.lock'))
+
+  def merge(self, name, output, header=None):
+    return merge_positional([self.shard_path(shard, name) for shard in range(self.n_shards)],
+      output, header=header)
+
+  def merged(self, outputs):
+    """Record the merge of `outputs`, a later merge only runs without them"""
+    _dump_atomic(self.path('merged.json'), { 'outputs': [abspath(output) for output in outputs] })
+    self._release(self.path('merge.lock'))
+
+__all__ = [ shard_of, owner_tag, PositionalWriter, read_positional, merge_positional, Heartbeat,
+  ShardQueue ]
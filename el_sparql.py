@@ -0,0 +1,98 @@
+"""SPARQL prefix expansion for EL mention Benchmark
+
+Replace every `name:local` of a query by `<uri + local>` for each of
+its `PREFIX name: <uri>` lines, and drop those lines. Patterns are
+compiled once per distinct block of prefix lines (shared by every query
+with the same block) and all the prefixes are expanded in one pass of a
+single alternation. When one pass could differ from expanding prefix by
+prefix (names that are a suffix of another or not plain words, uris
+holding a `name:`, bodies with `a:b:` chains) the expansion falls back
+to one substitution per prefix, in order, as it was always done.
+"""
+
+from functools import lru_cache
+
+__author__ = "Guillermo Echegoyen"
+__credits__ = ["Guillermo Echegoyen"]
+__license__ = "GPL v3"
+__version__ = "1.0.0"
+__maintainer__ = "Guillermo Echegoyen"
+__email__ = "gblanco@lsi.uned.es"
+__status__ = "Production"
+
+import re
+
+PREFIX_CACHE_SIZE = 1024
+
+prefix_def = re.compile('PREFIX ([^:]+):\s*<([^>]+)>')
+word_reg = re.compile('^\w+$')
+chain_reg = re.compile(':\w+:')
+
+def parse_prefix(line):
+  found = prefix_def.findall(line)
+  if not len(found):
+    raise ValueError('Bad prefix definition: {}'.format(line))
+  return found[0]
+
+class PrefixBlock(object):
+  """Compiled expansion of a block of prefix lines"""
+  def __init__(self, prefixes):
+    self.prefixes = [parse_prefix(line) for line in prefixes]
+    # prefix by prefix, in order
+    self.sequential = [(re.compile(r'{}:(\w+)'.format(name)), r'<{}\1>'.format(uri))
+      for name, uri in self.prefixes]
+    # the first definition of a name wins, as in sequential expansion
+    self.uris = {}
+    for name, uri in self.prefixes:
+      self.uris.setdefault(name, uri)
+    self.safe = self._is_safe()
+    self.regex = None
+    if self.safe and len(self.uris):
+      self.regex = re.compile('({}):(\w+)'.format('|'.join(self.uris)))
+
+  def _is_safe(self):
+    names = list(self.uris)
+    for name in names:
+      if not word_reg.match(name):
+        return False
+      for other in names:
+        if other != name and other.endswith(name):
+          return False
+      for uri in self.uris.values():
+        if name + ':' in uri:
+          return False
+    return all('\\' not in uri for uri in self.uris.values())
+
+  def _replace(self, match):
+    return '<' + self.uris[match.group(1)] + match.group(2) + '>'
+
+  def expand(self, query):
+    if self.regex is not None and not chain_reg.search(query):
+      return self.regex.sub(self._replace, query)
+    for reg, repl in self.sequential:
+      query = reg.sub(repl, query)
+    return query
+
+@lru_cache(maxsize=PREFIX_CACHE_SIZE)
+def get_prefix_block(prefixes):
+  return PrefixBlock(prefixes)
+
+def split_prefixes(query):
+  """Prefix lines and the rest of the query"""
+  rest_query_lines = []
+  prefixes = []
+  for line in query.split('\n'):
+    if line.lower().startswith('prefix'):
+      prefixes.append(line)
+    else:
+      rest_query_lines.append(line)
+  return tuple(prefixes), '\n'.join(rest_query_lines)
+
+def resolve_prefixes(query):
+  """Query without prefix lines, every prefixed name expanded"""
+  prefixes, rest_query = split_prefixes(query)
+  if not len(prefixes):
+    return rest_query
+  return get_prefix_block(prefixes).expand(rest_query)
+
+__all__ = [ PrefixBlock, get_prefix_block, split_prefixes, resolve_prefixes ]
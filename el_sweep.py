@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+
+"""Threshold sweep of the trigram method for EL mention Benchmark
+
+Accuracy of the trigram method against annotated mentions for a grid
+of `MentionSet.prob_thr` (token overlap to be part of a mention) and
+`MentionSet.align_thr` (overlap to trim a mention at the first/last dbr
+token) values. Everything that does not depend on them is computed
+once per (question, dbr): token overlap scores, overlap of every token
+with the first and last dbr tokens, and the edit distance of every
+span tried. Thresholds only decide which tokens pass, and equal masks
+of passing tokens give equal mentions, so most settings are a lookup.
+Mentions are the same match_by_trigrams finds with those thresholds.
+
+Usage:
+  el_sweep.py -a annotations/QALD_1.json [-a ...] [-p 0.6 0.7 ...] [-l 0.7 ...]
+"""
+
+from os.path import abspath, basename
+from el_entities import get_entity
+from el_evaluate import evaluate_from_annotation, read_annotations
+from el_process import dist, get_score_pairs
+from utils import clean_str, ngrams, tokenize_question, str_to_trigrams_dict, overlap_trigrams_score, overlap_trigrams_set_score, span_str_len, MinStore, MentionSet
+
+__author__ = "Guillermo Echegoyen"
+__credits__ = ["Guillermo Echegoyen"]
+__license__ = "GPL v3"
+__version__ = "1.0.0"
+__maintainer__ = "Guillermo Echegoyen"
+__email__ = "gblanco@lsi.uned.es"
+__status__ = "Production"
+
+import json
+import argparse
+
+# 0.05, 0.10 ... 1.0
+DEFAULT_PROB_GRID = [round(step * 0.05, 2) for step in range(1, 21)]
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+  '-a',
+  '--annotations',
+  type=str,
+  required=True,
+  action='append',
+  help='Annotated datasets (repeatable), eg: annotations/QALD_1.json.')
+parser.add_argument(
+  '-p',
+  '--prob-thr',
+  type=float,
+  nargs='+',
+  required=False,
+  default=DEFAULT_PROB_GRID,
+  help='Token overlap thresholds to try (MentionSet.prob_thr), 0.05 to 1.0 by default.')
+parser.add_argument(
+  '-l',
+  '--align-thr',
+  type=float,
+  nargs='+',
+  required=False,
+  default=[MentionSet.align_thr],
+  help='Trimming thresholds to try (MentionSet.align_thr).')
+parser.add_argument(
+  '-o',
+  '--output',
+  type=str,
+  required=False,
+  default=None,
+  help='Where to save the accuracy of every setting (json).')
+parser.add_argument(
+  '--batch-scoring',
+  required=False,
+  dest='batch_scoring',
+  action='store_true',
+  default=False,
+  help='Score the trigrams of all the annotations at once with numpy (see el_batch).')
+
+def _align(scores, start, end, align_thr):
+  # MentionSet.align over precomputed token scores
+  span_scores = scores[start:end]
+  score_max = max(span_scores)
+  if score_max > align_thr:
+    return span_scores.index(score_max)
+  return None
+
+class SweepPair(object):
+  """A (dbr, question) pair, as match_by_trigrams sees them, with all
+  the work that does not depend on the thresholds"""
+  def __init__(self, dbr, question, probs=None, trigrams=None):
+    self.dbr = dbr.lower()
+    self.parts, self.words, words_trigrams = tokenize_question(question)
+    if probs is None and trigrams is not None:
+      # dbr trigrams from the entity table, as process does
+      probs = [overlap_trigrams_set_score(trigrams, word_trigrams) for word_trigrams in words_trigrams]
+    elif probs is None:
+      tris = str_to_trigrams_dict(self.dbr)
+      probs = [overlap_trigrams_score(tris, word_trigrams) for word_trigrams in words_trigrams]
+    self.probs = probs
+    dbr_parts = self.dbr.split(' ')
+    self.first_scores = None
+    self.last_scores = None
+    if len(dbr_parts) >= 2:
+      first = str_to_trigrams_dict(dbr_parts[0])
+      last = str_to_trigrams_dict(dbr_parts[-1])
+      self.first_scores = [overlap_trigrams_score(first, ngrams(word)) for word in self.words]
+      self.last_scores = [overlap_trigrams_score(last, ngrams(word)) for word in self.words]
+    self.best_guess = None
+    # (start, end) -> distance to the dbr
+    self.distances = {}
+    # (passing tokens, align_thr) -> mention
+    self.mentions = {}
+
+  def _spans(self, mask):
+    # get_mentions_from_scores: runs of passing tokens, or the best guess
+    spans = []
+    start = None
+    for index, passed in enumerate(mask):
+      if passed and start is None:
+        start = index
+      elif not passed and start is not None:
+        spans.append((start, index))
+        start = None
+    if start is not None:
+      spans.append((start, len(mask)))
+    if not len(spans):
+      if self.best_guess is None:
+        # every token failed, the same for any threshold
+        words = self.words
+        best_guess = MinStore(key=lambda index: span_str_len(words, index, index +1))
+        for index, prob in enumerate(self.probs):
+          best_guess.store(index, prob)
+        self.best_guess = best_guess.get_item()
+      spans.append((self.best_guess, self.best_guess +1))
+    return spans
+
+  def _reduce(self, start, end, align_thr):
+    # MentionSet.reduce
+    if self.first_scores is None:
+      return start, end
+    start_trim = _align(self.first_scores, start, end, align_thr)
+    end_trim = _align(self.last_scores, start, end, align_thr)
+    start_trim = start_trim if start_trim is not None else 0
+    end_trim = (end_trim +1) if end_trim is not None else end - start
+    if start_trim > end_trim or (end_trim - start_trim) == 0:
+      start_trim = 0
+      end_trim = end - start
+    return start + start_trim, start + end_trim
+
+  def _distance(self, start, end):
+    distance = self.distances.get((start, end))
+    if distance is None:
+      distance = self.distances[(start, end)] = dist(' '.join(self.words[start:end]), self.dbr)
+    return distance
+
+  def mention(self, prob_thr, align_thr):
+    """match_by_trigrams with these thresholds"""
+    mask = tuple(prob > prob_thr for prob in self.probs)
+    key = (mask, align_thr)
+    if key not in self.mentions:
+      best = None
+      for order, (start, end) in enumerate(self._spans(mask)):
+        start, end = self._reduce(start, end, align_thr)
+        # ties as MinStore: shortest, then first
+        candidate = (self._distance(start, end), span_str_len(self.words, start, end), order,
+          start, end)
+        if best is None or candidate < best:
+          best = candidate
+      self.mentions[key] = ' '.join(self.parts[best[3]:best[4]])
+    return self.mentions[key]
+
+def sweep(annotations, prob_grid, align_grid, batch_scoring=False):
+  """Hits of every (prob_thr, align_thr) setting over the annotations,
+  trigrams are scored per pair unless `batch_scoring` (see
+  el_process.process_batch)"""
+  entities = [get_entity(annotation['dbr']) for annotation in annotations]
+  dbrs = [entity.label for entity in entities]
+  questions = [clean_str(annotation['question']) for annotation in annotations]
+  score_pairs = get_score_pairs() if batch_scoring else None
+  scores = [None] * len(annotations)
+  if score_pairs is not None:
+    scores = score_pairs([dbr.lower() for dbr in dbrs], questions)
+  settings = [(prob_thr, align_thr) for prob_thr in prob_grid for align_thr in align_grid]
+  hits = { setting: 0 for setting in settings }
+  pairs = {}
+  for annotation, entity, question, probs in zip(annotations, entities, questions, scores):
+    dbr = entity.label
+    pair = pairs.get((dbr, question))
+    if pair is None:
+      pair = pairs[(dbr, question)] = SweepPair(dbr, question, probs=probs,
+        trigrams=entity.trigrams)
+    for setting in settings:
+      try:
+        mention = pair.mention(*setting)
+      except ZeroDivisionError:
+        # empty tokens (eg: double spaces) make processing fail, a miss
+        continue
+      if evaluate_from_annotation({ 'mention': mention }, annotation):
+        hits[setting] += 1
+  return hits
+
+def main(FLAGS):
+  results = []
+  totals = {}
+  total = 0
+  for path in FLAGS.annotations:
+    annotations, _ = read_annotations(abspath(path))
+    # left without annotating (eg: el_datasets_compare records)
+    annotations = [annotation for annotation in annotations if 'mention' in annotation]
+    total += len(annotations)
+    hits = sweep(annotations, FLAGS.prob_thr, FLAGS.align_thr, batch_scoring=FLAGS.batch_scoring)
+    for (prob_thr, align_thr), setting_hits in hits.items():
+      totals[(prob_thr, align_thr)] = totals.get((prob_thr, align_thr), 0) + setting_hits
+      results.append({ 'annotations': basename(path), 'prob_thr': prob_thr,
+        'align_thr': align_thr, 'hits': setting_hits, 'total': len(annotations) })
+
+  best = max(totals.values()) if len(totals) else 0
+  print('{:>8} {:>9} {:>8} {:>12}'.format('prob_thr', 'align_thr', 'acc', 'hits'))
+  for (prob_thr, align_thr), hits in totals.items():
+    results.append({ 'annotations': 'total', 'prob_thr': prob_thr, 'align_thr': align_thr,
+      'hits': hits, 'total': total })
+    print('{:>8.3f} {:>9.3f} {:>8.4f} {:>12}{}'.format(prob_thr, align_thr,
+      hits / total if total else 0.0, '{}/{}'.format(hits, total), ' <- best' if hits == best else ''))
+
+  if FLAGS.output is not None:
+    json.dump(fp=open(FLAGS.output, 'w'), obj={ 'results': results }, indent=2)
+
+if __name__ == '__main__':
+  FLAGS, unparsed = parser.parse_known_args()
+  main(FLAGS)
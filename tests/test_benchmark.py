@@ -0,0 +1,66 @@
+import json
+import random
+
+from el_benchmark import AnnotationEvaluator
+from el_evaluate import evaluate_from_annotation
+from utils import find_question, find_error, QuestionIndex, ErrorIndex
+
+class ListWriter(object):
+  def __init__(self):
+    self.records = []
+
+  def write(self, record):
+    self.records.append(record)
+
+def reference_report(questions, annotations, annotations_errors):
+  # every processed question in memory, as the evaluation used to
+  hits = 0
+  errors = { k: [] for k in annotations_errors }
+  kept = []
+  questions_index = QuestionIndex(questions)
+  errors_index = ErrorIndex(annotations_errors)
+  for annotation in annotations:
+    question = find_question(annotation, questions_index)
+    if evaluate_from_annotation(question, annotation):
+      hits += 1
+    else:
+      errors.setdefault(find_error(annotation, errors_index), []).append(
+        [question['id'], question['question_id']])
+      kept.append(question)
+  return hits, errors, kept
+
+def random_case(rand):
+  mentions = ['Barack Obama', 'obama', 'Paris', 'paris ', 'Berlin']
+  questions = []
+  for position in range(rand.randint(1, 40)):
+    questions.append({ 'id': position, 'question_id': rand.randint(0, 12),
+      'dbr': rand.choice(['Barack_Obama', 'Paris', 'Berlin']), 'mention': rand.choice(mentions) })
+  annotations = []
+  for question in rand.sample(questions, rand.randint(1, len(questions))):
+    # several annotations may share a key
+    for _ in range(rand.randint(1, 2)):
+      annotations.append({ 'id': question['id'], 'question_id': question['question_id'],
+        'dbr': question['dbr'], 'mention': rand.choice(mentions) })
+  rand.shuffle(annotations)
+  errors = { 'wrong': [], 'partial': [] }
+  for annotation in annotations:
+    bucket = rand.choice(['wrong', 'partial', None])
+    if bucket is not None:
+      errors[bucket].append([annotation['id'], annotation['question_id']])
+  return questions, annotations, errors
+
+def test_streaming_annotation_evaluation_keeps_counts():
+  rand = random.Random(5)
+  for _ in range(300):
+    questions, annotations, annotations_errors = random_case(rand)
+    keep = ListWriter()
+    evaluator = AnnotationEvaluator(annotations, annotations_errors, keep=keep)
+    for question in questions:
+      evaluator.add(question)
+    errors, accuracy = evaluator.report()
+    hits, expected_errors, kept = reference_report(questions, annotations, annotations_errors)
+    assert evaluator.hits == hits
+    assert evaluator.total == len(annotations)
+    assert errors == json.dumps(expected_errors, ensure_ascii=False)
+    assert keep.records == kept
+    assert accuracy == 'Acc {:.4f} ({}/{})'.format(hits / len(annotations), hits, len(annotations))
@@ -0,0 +1,49 @@
+import random
+
+from el_distance import edit_distance, max_distance
+
+def reference_distance(s1, s2):
+  # plain dynamic programming Levenshtein
+  previous = list(range(len(s2) +1))
+  for i, c1 in enumerate(s1, 1):
+    current = [i]
+    for j, c2 in enumerate(s2, 1):
+      current.append(min(previous[j] +1, current[j -1] +1, previous[j -1] + (c1 != c2)))
+    previous = current
+  return previous[-1]
+
+def random_str(rand, alphabet='abcde é'):
+  return ''.join(rand.choice(alphabet) for _ in range(rand.randint(0, 12)))
+
+def test_edit_distance_matches_reference():
+  rand = random.Random(7)
+  for _ in range(3000):
+    s1, s2 = random_str(rand), random_str(rand)
+    assert edit_distance(s1, s2) == reference_distance(s1, s2), (s1, s2)
+
+def test_bounded_edit_distance():
+  rand = random.Random(11)
+  for _ in range(3000):
+    s1, s2 = random_str(rand), random_str(rand)
+    expected = reference_distance(s1, s2)
+    max_dist = rand.randint(0, 8)
+    distance = edit_distance(s1, s2, max_dist=max_dist)
+    if expected <= max_dist:
+      assert distance == expected, (s1, s2, max_dist)
+    else:
+      assert distance == max_dist +1, (s1, s2, max_dist)
+
+def test_long_patterns():
+  # patterns wider than a machine word
+  rand = random.Random(3)
+  for _ in range(200):
+    s1 = ''.join(rand.choice('ab') for _ in range(rand.randint(60, 90)))
+    s2 = ''.join(rand.choice('ab') for _ in range(rand.randint(60, 90)))
+    assert edit_distance(s1, s2) == reference_distance(s1, s2)
+
+def test_max_distance():
+  for size in range(1, 30):
+    for metric in [0.0, 0.1, 0.25, 1 / 3, 0.5, 0.7, 1.0, 1.5]:
+      max_dist = max_distance(metric, size)
+      assert max_dist / size <= metric
+      assert (max_dist +1) / size > metric
@@ -0,0 +1,119 @@
+import os
+import sys
+import glob
+import json
+import time
+import subprocess
+
+import pytest
+
+import el_benchmark
+from el_io import DatasetWriter
+from el_shards import ShardQueue, merge_positional, PositionalWriter, read_positional
+
+CODE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture
+def dataset(tmp_path):
+  """EL dataset of the annotated questions"""
+  path = str(tmp_path / 'el.json')
+  with DatasetWriter(path, header={ 'dataset': { 'id': 'annotations' } }) as writer:
+    for annotations in sorted(glob.glob(os.path.join(CODE_DIR, 'annotations', '*.json'))):
+      for annotation in json.load(open(annotations, 'r')):
+        writer.write({ key: annotation[key] for key in ('id', 'question_id', 'question', 'dbr') })
+  return path
+
+def benchmark(*args):
+  el_benchmark.main(el_benchmark.parser.parse_args(list(args)))
+
+def workers(n, *args):
+  # concurrent workers, as on several nodes
+  runs = [subprocess.Popen([sys.executable, os.path.join(CODE_DIR, 'el_benchmark.py')] + list(args),
+    cwd=CODE_DIR, stdout=subprocess.PIPE, stderr=subprocess.PIPE) for _ in range(n)]
+  for run in runs:
+    _, err = run.communicate()
+    assert run.returncode == 0, err.decode('utf-8')
+
+def read_bytes(path):
+  with open(path, 'rb') as fp:
+    return fp.read()
+
+def test_merge_positional(tmp_path):
+  paths = []
+  for shard, positions in enumerate([[0, 3, 4], [1, 5], [2]]):
+    path = str(tmp_path / 'shard_{}.json'.format(shard))
+    writer = PositionalWriter(path)
+    for position in positions:
+      writer.write({ 'id': position }, position)
+    writer.close()
+    assert [position for position, _ in read_positional(path)] == positions
+    paths.append(path)
+  output = str(tmp_path / 'merged.json')
+  assert merge_positional(paths, output) == 6
+  assert [record['id'] for record in json.load(open(output, 'r'))['questions']] == list(range(6))
+
+@pytest.mark.parametrize('method', [[], ['-b']])
+def test_sharded_workers_match_serial(tmp_path, dataset, method):
+  serial = str(tmp_path / 'serial.json')
+  benchmark('-d', dataset, '-o', serial, *method)
+  sharded = str(tmp_path / 'sharded.json')
+  workers(3, '-d', dataset, '-o', sharded, '--shards', '5', '--shard-dir',
+    str(tmp_path / 'shards'), *method)
+  assert read_bytes(sharded) == read_bytes(serial)
+
+def test_rerun_merges_missing_outputs(tmp_path, dataset):
+  serial = str(tmp_path / 'serial.json')
+  benchmark('-d', dataset, '-o', serial)
+  sharded = str(tmp_path / 'sharded.json')
+  args = ['-d', dataset, '-o', sharded, '--shards', '3', '--shard-dir', str(tmp_path / 'shards')]
+  benchmark(*args)
+  os.remove(sharded)
+  benchmark(*args)
+  assert read_bytes(sharded) == read_bytes(serial)
+
+def test_stale_shard_lock_is_taken_over(tmp_path, dataset):
+  directory = str(tmp_path / 'shards')
+  dead = ShardQueue(directory, 2, lock_timeout=0)
+  dead.split(dataset, [], {})
+  shard = dead.claim()
+  with dead.hold(dead.shard_lock(shard)) as heartbeat:
+    # no heartbeat comes in time
+    time.sleep(0.05)
+    alive = ShardQueue(directory, 2, lock_timeout=0)
+    assert alive.claim() == shard
+  assert heartbeat.lost
+  alive.complete(shard, {})
+  assert dead.claim() != shard
+
+def test_live_lock_is_kept(tmp_path, dataset):
+  directory = str(tmp_path / 'shards')
+  owner = ShardQueue(directory, 1, lock_timeout=0.5)
+  owner.split(dataset, [], {})
+  shard = owner.claim()
+  with owner.hold(owner.shard_lock(shard)) as heartbeat:
+    time.sleep(1.5)
+    assert ShardQueue(directory, 1, lock_timeout=0.5).claim() is None
+  assert not heartbeat.lost
+
+def test_stale_split_and_merge_locks(tmp_path, dataset):
+  serial = str(tmp_path / 'serial.json')
+  benchmark('-d', dataset, '-o', serial)
+  directory = tmp_path / 'shards'
+  directory.mkdir()
+  # left by dead workers
+  for lock in ('split.lock', 'merge.lock'):
+    (directory / lock).write_text('{"host": "dead", "pid": 1}')
+  time.sleep(0.05)
+  sharded = str(tmp_path / 'sharded.json')
+  benchmark('-d', dataset, '-o', sharded, '--shards', '3', '--shard-dir', str(directory),
+    '--lock-timeout', '0')
+  assert read_bytes(sharded) == read_bytes(serial)
+  assert not any(name.startswith('.') for name in os.listdir(str(directory)))
+
+def test_edited_dataset_is_not_reused(tmp_path, dataset):
+  directory = str(tmp_path / 'shards')
+  ShardQueue(directory, 2).split(dataset, [], {})
+  with open(dataset, 'a') as fp:
+    fp.write(' ')
+  with pytest.raises(ValueError):
+    ShardQueue(directory, 2).split(dataset, [], {})
@@ -1,4 +1,5 @@
 from collections import defaultdict
+from functools import lru_cache
 
 __author__ = "Guillermo Echegoyen"
 __credits__ = ["Guillermo Echegoyen"]
@@ -9,6 +10,7 @@ __email__ = "gblanco@lsi.uned.es"
 __status__ = "Production"
 
 import re
+import heapq
 import unicodedata
 
 trim_reg = [
@@ -21,6 +23,14 @@ trim_reg = [
   [re.compile('_'), ' '],
   [re.compile('\s+'), ' ']]
 
+# trim_reg fused: trailing disambiguation, '?', ',' and '.' (removed in
+# that order) in one pass, then '-', '_' and spaces collapsed in another
+trim_end_reg = re.compile('\.?,?\??(?:_\([^\)]+\))?$')
+space_reg = re.compile('[-_\s]+')
+
+CLEAN_STR_CACHE_SIZE = 2 ** 16
+QUESTION_CACHE_SIZE = 2 ** 14
+
 def ngrams(word, n=3):
   if len(word) < n:
     return [word]
@@ -30,18 +40,62 @@ def ngrams(word, n=3):
   return grams
 
 # global trim_reg
-def clean_str(data):
+def _trim_str(data):
   global trim_reg
-  ret = data.replace('http://dbpedia.org/resource/', '')
-  # remove dissambiguation from dbpedia (eg: TNT -> TNT_(TV_channel))
+  ret = data
   for reg, repl in trim_reg:
     ret = re.sub(reg, repl, ret)
+  return ret
+
+# global trim_end_reg, space_reg
+def _fast_trim_str(data):
+  global trim_end_reg, space_reg
+  ret = trim_end_reg.sub('', data, count=1)
+  if ret.startswith(','):
+    ret = ret[1:]
+  return space_reg.sub(' ', ret)
+
+@lru_cache(maxsize=CLEAN_STR_CACHE_SIZE)
+def clean_str(data):
+  ret = data.replace('http://dbpedia.org/resource/', '')
+  # remove dissambiguation from dbpedia (eg: TNT -> TNT_(TV_channel))
+  if '\n' in ret:
+    # '$' also matches before a trailing newline, trim pass by pass
+    ret = _trim_str(ret).strip()
+  else:
+    ret = _fast_trim_str(ret).strip()
+  try:
+    # nothing to normalize (str.isascii is 3.7+)
+    ret.encode('ascii')
+    return ret
+  except UnicodeEncodeError:
+    pass
   # remove accents, umlaude... François -> Francois
   # https://stackoverflow.com/questions/517923/what-is-the-best-way-to-remove-
   # accents-in-a-python-unicode-string
-  ret = unicodedata.normalize('NFKD', ret.strip())
+  ret = unicodedata.normalize('NFKD', ret)
   return str(u"".join([c for c in ret if not unicodedata.combining(c)]))
 
+def clean_str_stats():
+  info = clean_str.cache_info()
+  calls = info.hits + info.misses
+  return {
+    'hits': info.hits,
+    'misses': info.misses,
+    'hit_rate': info.hits / calls if calls else 0.0,
+    'size': info.currsize,
+    'maxsize': info.maxsize
+  }
+
+@lru_cache(maxsize=QUESTION_CACHE_SIZE)
+def tokenize_question(question):
+  """Tokens, lowered tokens and the trigrams of each lowered token of a
+  question. Cached, every dbr of the same question shares them"""
+  tokens = tuple(question.split(' '))
+  words = tuple(question.lower().split(' '))
+  words_trigrams = tuple(tuple(ngrams(word.lower())) for word in words)
+  return tokens, words, words_trigrams
+
 def str_to_trigrams_dict(data):
   tris = defaultdict(int)
   for point in data.split(' '):
@@ -59,7 +113,81 @@ def overlap_trigrams_score(trigrams_dict, word_trigrams):
   prob = common_tri/max_com
   return prob
 
+def overlap_trigrams_set_score(trigrams, word_trigrams):
+  """overlap_trigrams_score against a set of trigrams (the keys of a
+  str_to_trigrams_dict, see el_entities)"""
+  common_tri = 0
+  for gram in word_trigrams:
+    if gram in trigrams:
+      common_tri += 1
+  return common_tri/max(1, len(word_trigrams))
+
+class QuestionIndex(object):
+  """Hash index over a dataset keyed on (question_id, dbr), keeps the
+  first datapoint of each key, as find_question does"""
+  def __init__(self, dataset):
+    self.index = {}
+    for q in dataset:
+      self.index.setdefault((q['question_id'], q['dbr']), q)
+
+  def __len__(self):
+    return len(self.index)
+
+  def find(self, question):
+    return self.index.get((question['question_id'], question['dbr']))
+
+class ErrorIndex(object):
+  """Hash index over error buckets keyed on [id, question_id], keeps the
+  first bucket of each key, as find_error does"""
+  def __init__(self, errors):
+    self.index = {}
+    for error_key in errors:
+      for error in errors[error_key]:
+        self.index.setdefault(tuple(error), error_key)
+
+  def __len__(self):
+    return len(self.index)
+
+  def find(self, question):
+    return self.index.get((question['id'], question['question_id']))
+
+class Deduper(object):
+  """Set of seen keys, `add` tells whether a key is new. Keys live in
+  memory, or in a sqlite file at `path` when they do not fit in RAM"""
+  def __init__(self, path=None):
+    self.path = path
+    self.count = 0
+    self.keys = None
+    self.db = None
+    if path is None:
+      self.keys = set()
+    else:
+      import sqlite3
+      self.db = sqlite3.connect(path)
+      self.db.execute('CREATE TABLE IF NOT EXISTS seen (key TEXT PRIMARY KEY) WITHOUT ROWID')
+      self.db.execute('DELETE FROM seen')
+
+  def __len__(self):
+    return self.count
+
+  def add(self, key):
+    if self.keys is not None:
+      if key in self.keys:
+        return False
+      self.keys.add(key)
+    elif not self.db.execute('INSERT OR IGNORE INTO seen VALUES (?)', (key,)).rowcount:
+      return False
+    self.count += 1
+    return True
+
+  def close(self):
+    if self.db is not None:
+      self.db.close()
+      self.db = None
+
 def find_question(question, dataset):
+  if isinstance(dataset, QuestionIndex):
+    return dataset.find(question)
   for q in dataset:
     if question['question_id'] == q['question_id'] and \
       question['dbr'] == q['dbr']:
@@ -67,60 +195,130 @@ def find_question(question, dataset):
   return None
 
 def find_error(question, errors):
+  if isinstance(errors, ErrorIndex):
+    return errors.find(question)
   search = [question['id'], question['question_id']]
   for error_key in errors:
     if search in errors[error_key]:
       return error_key
   return None
 
+def _str_len(item):
+  return len(str(item))
+
 class MinStore(object):
-  def __init__(self, item=None, metric=None, cmp=None):
+  """Keep the best item stored so far, ties are broken by the shortest
+  one (`key`, the length of its string form by default), only computed
+  when metrics are equal"""
+  __slots__ = ('item', 'metric', 'empty', 'maximize', 'key', 'item_key')
+
+  def __init__(self, item=None, metric=None, cmp=None, key=None):
     self.item = item
     self.metric = metric
     self.empty = item is None and metric is None
-    if cmp == 'min_metric':
-      self.cmp = self._min_metric_min_len
-    else:
-      # if cmp != 'max_metric':
-      # unkown metric
-      self.cmp = self._max_metric_min_len
-
-  def _max_metric_min_len(self, old_metric, new_metric, old_item, new_item):
-    cmp_new_item = new_item[0] if type(new_item) is list else str(new_item)
-    cmp_old_item = old_item[0] if type(old_item) is list else str(old_item)
-    return (old_metric < new_metric or (old_metric == new_metric and
-      len(cmp_new_item) < len(cmp_old_item)))
-
-  def _min_metric_min_len(self, old_metric, new_metric, old_item, new_item):
-    cmp_new_item = new_item[0] if type(new_item) is list else str(new_item)
-    cmp_old_item = old_item[0] if type(old_item) is list else str(old_item)
-    return (new_metric < old_metric or (new_metric == old_metric and
-       len(cmp_new_item) < len(cmp_old_item)))
+    # if cmp != 'max_metric' and cmp != 'min_metric':
+    # unkown metric, maximize
+    self.maximize = cmp != 'min_metric'
+    self.key = _str_len if key is None else key
+    self.item_key = None
 
   def store(self, item, metric):
     if self.empty:
       self.item = item
       self.metric = metric
-    elif self.cmp(self.metric, metric, self.item, item):
-      # maximize metric, minimize size
+      self.item_key = None
+    elif self.metric == metric:
+      # same metric, minimize size
+      if self.item_key is None:
+        self.item_key = self.key(self.item)
+      item_key = self.key(item)
+      if item_key < self.item_key:
+        self.item = item
+        self.item_key = item_key
+    elif (self.metric < metric) if self.maximize else (metric < self.metric):
       self.item = item
       self.metric = metric
+      self.item_key = None
     self.empty = item is None and metric is None
 
   def get_item(self):
     return self.item
 
+class TopKStore(object):
+  """Keep the `k` items with the lowest metric stored so far, in a
+  bounded heap, ties broken as MinStore does (shortest `key`, then the
+  first stored), so the best item is always the one MinStore keeps.
+  Once full, `metric` is the kth best metric, items over it can not get
+  in (None until then, same as an empty MinStore)"""
+  __slots__ = ('k', 'key', 'heap', 'count', 'metric')
+
+  def __init__(self, k, key=None):
+    if k < 1:
+      raise ValueError('k must be positive, got {}'.format(k))
+    self.k = k
+    self.key = _str_len if key is None else key
+    # worst item on top: (-metric, -key, -order, item)
+    self.heap = []
+    self.count = 0
+    self.metric = None
+
+  def store(self, item, metric):
+    self.count += 1
+    if len(self.heap) < self.k:
+      heapq.heappush(self.heap, (-metric, -self.key(item), -self.count, item))
+    elif metric <= self.metric:
+      worst_metric, worst_key = -self.heap[0][0], -self.heap[0][1]
+      item_key = self.key(item)
+      if metric < worst_metric or item_key < worst_key:
+        heapq.heapreplace(self.heap, (-metric, -item_key, -self.count, item))
+    else:
+      return
+    if len(self.heap) == self.k:
+      self.metric = -self.heap[0][0]
+
+  def get_items(self):
+    """(item, metric) pairs, best first"""
+    return [(entry[3], -entry[0]) for entry in sorted(self.heap, reverse=True)]
+
+  def get_item(self):
+    return self.get_items()[0][0] if len(self.heap) else None
+
+def _list_str_len(reprs_len, size):
+  # length of str() of a list with `size` items given their reprs length
+  return 2 + reprs_len + 2 * (size -1) if size else 2
+
+def span_str_len(words, start, end):
+  """Length of str(MentionSet(words, start, end)), without building it"""
+  size = max(0, end - start)
+  words_len = sum(len(repr(word)) for word in words[start:end])
+  indexes_len = sum(len(str(index)) for index in range(start, end))
+  # 'Mention: ' + words + ', Index ' + indexes
+  return 17 + _list_str_len(words_len, size) + _list_str_len(indexes_len, size)
+
+def percentile(sorted_values, pct):
+  """Nearest rank percentile of already sorted values, 0.0 if none"""
+  if not len(sorted_values):
+    return 0.0
+  rank = max(1, int(-(-pct * len(sorted_values) // 100)))
+  return sorted_values[rank -1]
+
 class MentionSet(object):
-  def __init__(self, mention=None, indexes=None, prob=0.0):
-    indexes = [] if indexes is None else indexes
-    mention = [] if mention is None else mention
-    self.mention = mention
-    self.indexes = indexes
+  """Span of consecutive words, as [start, end) offsets into the
+  (shared) words list of a question"""
+  __slots__ = ('words', 'start', 'end', 'prob')
+  # token overlap to be part of a mention
+  prob_thr = 0.7
+  # overlap of a mention token with the first/last dbr token to trim there
+  align_thr = 0.7
+
+  def __init__(self, words=None, start=0, end=None, prob=0.0):
+    self.words = [] if words is None else words
+    self.start = start
+    self.end = start if end is None else end
     self.prob = prob
-    self.prob_thr = 0.7
 
   def __len__(self):
-    return ''.join(self.mention)
+    return sum(len(word) for word in self.words[self.start:self.end])
 
   def __repr__(self):
     return self.__str__()
@@ -128,19 +326,24 @@ class MentionSet(object):
   def __str__(self):
     return 'Mention: {}, Index {}'.format(self.get_mention(), self.get_indexes())
 
+  def str_len(self):
+    return span_str_len(self.words, self.start, self.end)
+
   def get_mention(self):
-    return self.mention
+    return self.words[self.start:self.end]
 
   def get_indexes(self):
-    return self.indexes
+    return list(range(self.start, self.end))
 
   def is_empty(self):
-    return len(self.mention) == 0
+    return self.end <= self.start
 
-  def append(self, word, index, prob):
+  def append(self, index, prob):
+    """Extend the span up to word `index` if `prob` is over the threshold"""
     if prob > self.prob_thr:
-      self.mention.append(word)
-      self.indexes.append(index)
+      if self.is_empty():
+        self.start = index
+      self.end = index +1
       self.prob = prob
     return prob > self.prob_thr
 
@@ -149,16 +352,16 @@ class MentionSet(object):
     global overlap_trigrams_score, str_to_trigrams_dict
     # alignment part trigrams
     trigrams = str_to_trigrams_dict(dbr_part)
-    scores = [overlap_trigrams_score(trigrams, ngrams(mention)) for mention in self.mention]
+    scores = [overlap_trigrams_score(trigrams, ngrams(mention)) for mention in self.get_mention()]
     score_max = max(scores)
     trim = None
-    if score_max > 0.7:
+    if score_max > self.align_thr:
       trim = scores.index(score_max)
     return trim
 
   def _get_trim_indexes(self, dbr):
     start_trim = 0
-    end_trim = len(self.mention)
+    end_trim = self.end - self.start
     dbr_parts = dbr.lower().split(' ')
     if len(dbr_parts) < 2:
       return start_trim, end_trim
@@ -167,27 +370,36 @@ class MentionSet(object):
     end_trim = self.align(dbr_parts[-1])
     start_trim = start_trim if start_trim is not None else 0
     # starts from 0, compensate
-    end_trim = (end_trim +1) if end_trim is not None else len(self.mention)
+    end_trim = (end_trim +1) if end_trim is not None else self.end - self.start
 
     if start_trim > end_trim or (end_trim - start_trim) == 0:
       # print('Warning! Bad trimming', self.mention, dbr)
       start_trim = 0
-      end_trim = len(self.mention)
+      end_trim = self.end - self.start
 
     return start_trim, end_trim
 
   def reduce(self, dbr):
     start_trim, end_trim = self._get_trim_indexes(dbr)
-    self.mention = self.mention[start_trim:end_trim]
-    self.indexes = self.indexes[start_trim:end_trim]
+    self.end = self.start + end_trim
+    self.start = self.start + start_trim
 
 __all__ = [
   ngrams,
   find_question,
   find_error,
+  QuestionIndex,
+  ErrorIndex,
+  Deduper,
   clean_str,
+  clean_str_stats,
+  tokenize_question,
   str_to_trigrams_dict,
   overlap_trigrams_score,
+  overlap_trigrams_set_score,
   MinStore,
+  TopKStore,
+  span_str_len,
+  percentile,
   MentionSet
 ]